@@ -0,0 +1,143 @@
+"""Generate synthetic AIMD outputs and databases for the benchmarks, without running VASP."""
+import os
+import os.path as op
+import numpy as np
+import yaml
+from ase import Atoms
+from ase.calculators.singlepoint import SinglePointCalculator
+from dipole_aimd.parser.parser_dipole import StoreAtomsinASEdb, create_indices
+
+# Cell of all the synthetic trajectories
+CELL = np.diag([10.0, 10.0, 20.0])
+
+def get_symbols(natoms):
+    """Half Pt and half O atoms."""
+    return ['Pt'] * (natoms // 2) + ['O'] * (natoms - natoms // 2)
+
+def write_vasprun(filename, nframes, natoms, seed=0, pstress=0.0):
+    """Write a vasprun.xml file with nframes ionic steps of natoms atoms, with energies and a dipole."""
+    rng = np.random.default_rng(seed)
+    with open(filename, 'w') as handle:
+        write = handle.write
+        write('<?xml version="1.0" encoding="ISO-8859-1"?>\n<modeling>\n')
+        write(' <kpoints>\n  <varray name="kpointlist" >\n   <v>  0.0 0.0 0.0 </v>\n  </varray>\n')
+        write('  <varray name="weights" >\n   <v> 1.0 </v>\n  </varray>\n </kpoints>\n')
+        write(' <parameters>\n  <separator name="general" >\n   <i type="string" name="SYSTEM">synthetic</i>\n')
+        write(f'   <i name="PSTRESS">  {pstress} </i>\n  </separator>\n </parameters>\n')
+        write(f' <atominfo>\n  <atoms> {natoms} </atoms>\n  <array name="atoms" >\n   <set>\n')
+        for symbol in get_symbols(natoms):
+            write(f'    <rc><c>{symbol}</c><c>1</c></rc>\n')
+        write('   </set>\n  </array>\n </atominfo>\n')
+
+        def write_structure(name, scaled_positions):
+            write(' <structure name="%s" >\n' % name if name else ' <structure>\n')
+            write('  <crystal>\n   <varray name="basis" >\n')
+            for vector in CELL:
+                write('    <v> %16.8f %16.8f %16.8f </v>\n' % tuple(vector))
+            write('   </varray>\n  </crystal>\n  <varray name="positions" >\n')
+            for position in scaled_positions:
+                write('   <v> %16.8f %16.8f %16.8f </v>\n' % tuple(position))
+            write('  </varray>\n </structure>\n')
+
+        write_structure('initialpos', rng.uniform(0, 1, (natoms, 3)))
+        for _ in range(nframes):
+            energy = -100.0 + rng.normal()
+            write(' <calculation>\n  <scstep>\n   <energy>\n')
+            write('    <i name="e_fr_energy"> %16.8f </i>\n    <i name="e_0_energy"> %16.8f </i>\n   </energy>\n'
+                  % (energy, energy))
+            write('   <dipole>\n    <v name="dipole"> %16.8f %16.8f %16.8f </v>\n   </dipole>\n  </scstep>\n'
+                  % tuple(rng.normal(size=3)))
+            write_structure(None, rng.uniform(0, 1, (natoms, 3)))
+            write('  <varray name="forces" >\n')
+            for force in rng.normal(size=(natoms, 3)):
+                write('   <v> %16.8f %16.8f %16.8f </v>\n' % tuple(force))
+            write('  </varray>\n  <energy>\n')
+            write('   <i name="e_fr_energy"> %16.8f </i>\n   <i name="e_0_energy"> %16.8f </i>\n  </energy>\n'
+                  ' </calculation>\n' % (energy, energy))
+        write('</modeling>\n')
+
+def write_outcar(filename, nframes, natoms, seed=0):
+    """Write an OUTCAR file with nframes ionic steps of natoms atoms, with energies and a dipole."""
+    rng = np.random.default_rng(seed)
+    npt = natoms // 2
+    with open(filename, 'w') as handle:
+        write = handle.write
+        write(' POTCAR:    PAW_PBE Pt 04Feb2005\n POTCAR:    PAW_PBE O 08Apr2002\n' * 2)
+        write(f'   ions per type =  {npt} {natoms - npt}\n')
+        for step in range(nframes):
+            energy = -100.0 + rng.normal()
+            write('--------------------------------------- Iteration %6d(   1)  '
+                  '---------------------------------------\n' % (step + 1))
+            write(' dipolmoment  %14.6f %14.6f %14.6f electrons x Angstroem\n' % tuple(rng.normal(size=3)))
+            write('      direct lattice vectors                 reciprocal lattice vectors\n')
+            for vector in CELL:
+                write('    %12.9f %12.9f %12.9f     %12.9f %12.9f %12.9f\n' % (tuple(vector) + tuple(vector / 100)))
+            write(' POSITION                                       TOTAL-FORCE (eV/Angst)\n')
+            write(' ' + '-' * 83 + '\n')
+            positions = rng.uniform(0, 1, (natoms, 3)) @ CELL
+            for position, force in zip(positions, rng.normal(size=(natoms, 3))):
+                write('   %12.5f %12.5f %12.5f    %13.6f %13.6f %13.6f\n' % (tuple(position) + tuple(force)))
+            write(' ' + '-' * 83 + '\n')
+            write('  FREE ENERGIE OF THE ION-ELECTRON SYSTEM (eV)\n  ---------------------------------------------------\n')
+            write('  free  energy   TOTEN  =  %18.8f eV\n\n' % energy)
+            write('  energy  without entropy=  %18.8f  energy(sigma->0) =  %18.8f\n' % (energy, energy))
+
+def make_campaign(root, default, nstates=2, nruns=2, nframes=100, natoms=32, seed=0):
+    """Write the folders of nstates states with nruns runs each, laid out for a --default mode of the parser.
+
+    None: <state>/run_<n>/ with details.yaml and vasprun.xml
+    recursive: <state>/aimd/vasprun.xml with every restart in a restart folder below
+    all_in_one: <state>/OUTCAR_<n>
+    run_folders: <state>/run_<n>/OUTCAR
+    """
+    for state_index in range(nstates):
+        state = f'state{state_index}'
+        for run_number in range(nruns):
+            run_seed = seed + 1000 * state_index + run_number
+            if default is None:
+                folder = op.join(root, state, f'run_{run_number}')
+                os.makedirs(folder, exist_ok=True)
+                with open(op.join(folder, 'details.yaml'), 'w') as handle:
+                    yaml.safe_dump({'state': state, 'run_number': run_number}, handle)
+                write_vasprun(op.join(folder, 'vasprun.xml'), nframes, natoms, run_seed)
+            elif default == 'recursive':
+                folder = op.join(root, state, 'aimd', *(['restart'] * run_number))
+                os.makedirs(folder, exist_ok=True)
+                write_vasprun(op.join(folder, 'vasprun.xml'), nframes, natoms, run_seed)
+            elif default == 'all_in_one':
+                os.makedirs(op.join(root, state), exist_ok=True)
+                write_outcar(op.join(root, state, f'OUTCAR_{run_number}'), nframes, natoms, run_seed)
+            elif default == 'run_folders':
+                folder = op.join(root, state, f'run_{run_number}')
+                os.makedirs(folder, exist_ok=True)
+                write_outcar(op.join(folder, 'OUTCAR'), nframes, natoms, run_seed)
+            else:
+                raise ValueError(f'Unknown default {default}')
+
+def fill_database(dbname, nstates=2, nruns=2, nframes=100, natoms=32, seed=0):
+    """Write an ASE database with the frames of nstates states with nruns runs each, as the parser does."""
+    rng = np.random.default_rng(seed)
+    for state_index in range(nstates):
+        for run_number in range(nruns):
+            method = StoreAtomsinASEdb(dbname=dbname, foldername='')
+            method.state = f'state{state_index}'
+            method.run_number = run_number
+            frames = []
+            for _ in range(nframes):
+                atoms = Atoms(get_symbols(natoms), positions=rng.uniform(0, 1, (natoms, 3)) @ CELL,
+                              cell=CELL, pbc=True)
+                atoms.calc = SinglePointCalculator(atoms, energy=-100.0 + rng.normal(),
+                                                   forces=rng.normal(size=(natoms, 3)),
+                                                   dipole=rng.normal(size=3))
+                frames.append(atoms)
+            method.write_trajectory(frames)
+    create_indices(dbname)
+
+def write_cation_yaml(filename, dimensions=(4, 4), water_layers=6, water_per_layer=16):
+    """Write the inputs of CreateCation for a Pt(111) slab with layers of water and a Na cation."""
+    inputs = {'facet': '111', 'metal_name': 'Pt', 'a': 3.92, 'metal_layers': 4, 'cation': 'Na',
+              'layer_of_cation': 2, 'dimensions': list(dimensions), 'water_layers': water_layers,
+              'water_per_layer': water_per_layer, 'water_layer_distance': 3.0, 'vacuum': 20,
+              'cutoff_fraction': 0.9}
+    with open(filename, 'w') as handle:
+        yaml.safe_dump(inputs, handle)
@@ -0,0 +1,187 @@
+"""Time the ingest, analysis and structure generation on synthetic data and write the results as json.
+
+Run from the root of the repository, e.g.
+
+    python benchmarks/run.py --frames 200 --atoms 64 --output results.json
+    python benchmarks/run.py --output new.json --compare results.json
+"""
+import contextlib
+import json
+import os
+import os.path as op
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import click
+import numpy as np
+import ase
+from dipole_aimd.parser.parser import store_to_database
+from dipole_aimd.analysis.analyse_dipole import ParseDipole
+from dipole_aimd.analysis.analyse_energy import ParseEnergy
+from dipole_aimd.analysis.engine import AnalysisEngine, CumulativeAverage, RawSeries
+from dipole_aimd.calculation.create_cation import CreateCation, SlabCache
+from fixtures import make_campaign, fill_database, write_cation_yaml
+
+# --default modes of the parser
+DEFAULTS = [None, 'recursive', 'all_in_one', 'run_folders']
+
+def time_call(function, repeat):
+    """Return the wall times of repeat calls of function, with its output silenced."""
+    times = []
+    for _ in range(repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return times
+
+def get_result(name, times, items, unit, **parameters):
+    """A result with the best time and the throughput of the best run."""
+    best = min(times)
+    return {'name': name, 'parameters': parameters, 'times': times, 'best': best,
+            'unit': unit, 'items': items, 'rate': items / best if best > 0 else float('inf')}
+
+def benchmark_ingest(workdir, nstates, nruns, nframes, natoms, repeat):
+    """Time the parser for every --default mode, storing the atoms objects and only the scalars."""
+    results = []
+    for default in DEFAULTS:
+        root = op.join(workdir, f'ingest_{default}')
+        make_campaign(root, default, nstates, nruns, nframes, natoms)
+        for options in ([], ['--scalars-only']):
+            dbname = op.join(workdir, f'ingest_{default}.db')
+
+            def ingest():
+                if op.exists(dbname):
+                    os.remove(dbname)
+                args = ['--dbname', dbname] + (['--default', default] if default else []) + options
+                cwd = os.getcwd()
+                os.chdir(root)
+                try:
+                    store_to_database.main(args, standalone_mode=False)
+                finally:
+                    os.chdir(cwd)
+
+            name = f"ingest/{default or 'details'}" + ('/scalars-only' if options else '')
+            results.append(get_result(name, time_call(ingest, repeat), nstates * nruns * nframes, 'frames',
+                                      states=nstates, runs=nruns, frames=nframes, atoms=natoms))
+    return results
+
+def benchmark_analysis(workdir, nstates, nruns, nframes, natoms, repeat):
+    """Time ParseDipole, ParseEnergy and both in a single AnalysisEngine pass on a pre-filled database.
+
+    ParseDipole is also timed on two copies of the database merged by two workers,
+    so that every frame is read twice and deduplicated.
+    """
+    dbname = op.join(workdir, 'analysis.db')
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        fill_database(dbname, nstates, nruns, nframes, natoms)
+    copy_dbname = op.join(workdir, 'analysis_copy.db')
+    shutil.copyfile(dbname, copy_dbname)
+    output = op.join(workdir, 'analysis')
+
+    def run_engine():
+        engine = AnalysisEngine(dbname)
+        engine.add(CumulativeAverage('dipole_z', output + '_dipole.json'))
+        engine.add(CumulativeAverage('energy', output + '_energy.json'))
+        engine.add(RawSeries('energy', output + '_energy_raw.json'))
+        engine.run()
+
+    calls = {
+        'analysis/ParseDipole': lambda: ParseDipole(dbname, output + '_dipole.json'),
+        'analysis/ParseEnergy': lambda: ParseEnergy(dbname, output + '_energy.json', output + '_energy_raw.json'),
+        'analysis/AnalysisEngine': run_engine,
+        'analysis/ParseDipole/merged-workers-2': lambda: ParseDipole([dbname, copy_dbname], output + '_dipole.json',
+                                                                     workers=2),
+    }
+    return [get_result(name, time_call(function, repeat), nstates * nruns * nframes, 'frames',
+                       states=nstates, runs=nruns, frames=nframes, atoms=natoms)
+            for name, function in calls.items()]
+
+def benchmark_structures(workdir, dimensions, water_layers, water_per_layer, repeat):
+    """Time CreateCation for a structure with a new slab and one with the slab from the cache."""
+    yaml_file = op.join(workdir, 'cation.yaml')
+    write_cation_yaml(yaml_file, dimensions, water_layers, water_per_layer)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        shared_cache = SlabCache()
+        results = []
+        for name, get_cache in (('structures/CreateCation', SlabCache),
+                                ('structures/CreateCation/cached-slab', lambda: shared_cache)):
+            # The same seeds for both, so that only the slab differs
+            seeds = iter(range(repeat))
+            times = time_call(lambda: CreateCation(yaml_file, seed=next(seeds), slab_cache=get_cache()), repeat)
+            results.append(get_result(name, times, 1, 'structures', dimensions=list(dimensions),
+                                      water_layers=water_layers, water_per_layer=water_per_layer))
+    finally:
+        os.chdir(cwd)
+    return results
+
+def get_metadata(parameters):
+    """The environment the benchmarks were run in."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=op.dirname(op.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'date': datetime.now(timezone.utc).isoformat(), 'commit': commit,
+            'python': sys.version.split()[0], 'numpy': np.__version__, 'ase': ase.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'parameters': parameters}
+
+def compare(results, baseline_file, threshold):
+    """Print the ratio of the best times to those of a baseline and return the names that got slower."""
+    with open(baseline_file, 'r') as handle:
+        baseline = {result['name']: result for result in json.load(handle)['results']}
+    regressions = []
+    for result in results:
+        reference = baseline.get(result['name'])
+        if reference is None:
+            continue
+        ratio = result['best'] / reference['best']
+        flag = ' slower' if ratio > threshold else ''
+        print(f"{result['name']:45s} {reference['best']:10.4f} s -> {result['best']:10.4f} s ({ratio:5.2f}x){flag}")
+        if ratio > threshold:
+            regressions.append(result['name'])
+    return regressions
+
+@click.command()
+@click.option('--output', default='benchmark_results.json', help='Json file the results are written to.')
+@click.option('--only', default='ingest,analysis,structures', help='Comma separated groups of benchmarks to run.')
+@click.option('--states', default=2, type=int, help='Number of states of the synthetic trajectories.')
+@click.option('--runs', default=2, type=int, help='Number of runs of every state.')
+@click.option('--frames', default=100, type=int, help='Number of frames of every run.')
+@click.option('--atoms', default=32, type=int, help='Number of atoms of every frame.')
+@click.option('--dimensions', default='4x4', help='Repetitions of the slab of the generated structures.')
+@click.option('--water-layers', default=6, type=int, help='Number of water layers of the generated structures.')
+@click.option('--water-per-layer', default=16, type=int, help='Number of water molecules per layer.')
+@click.option('--repeat', default=3, type=int, help='Number of times every benchmark is timed.')
+@click.option('--compare', 'baseline', default=None, help='Json file of earlier results to compare with.')
+@click.option('--threshold', default=1.2, type=float, help='Ratio of the best times above which a benchmark got slower.')
+def run_benchmarks(output, only, states, runs, frames, atoms, dimensions, water_layers, water_per_layer,
+                   repeat, baseline, threshold):
+    """Runs the benchmarks on synthetic data generated in a temporary folder."""
+    groups = set(only.split(','))
+    dimensions = [int(size) for size in dimensions.split('x')]
+    parameters = {'states': states, 'runs': runs, 'frames': frames, 'atoms': atoms, 'dimensions': dimensions,
+                  'water_layers': water_layers, 'water_per_layer': water_per_layer, 'repeat': repeat}
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        if 'ingest' in groups:
+            results += benchmark_ingest(workdir, states, runs, frames, atoms, repeat)
+        if 'analysis' in groups:
+            results += benchmark_analysis(workdir, states, runs, frames, atoms, repeat)
+        if 'structures' in groups:
+            results += benchmark_structures(workdir, dimensions, water_layers, water_per_layer, repeat)
+    for result in results:
+        print(f"{result['name']:45s} {result['best']:10.4f} s {result['rate']:12.1f} {result['unit']}/s")
+    with open(output, 'w') as handle:
+        json.dump({'metadata': get_metadata(parameters), 'results': results}, handle, indent=1)
+    if baseline is not None and compare(results, baseline, threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    run_benchmarks()
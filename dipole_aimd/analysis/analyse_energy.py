@@ -1,13 +1,6 @@
 """Parse the energy from an AIMD calculation stored in an ASE database."""
-import json
 from dataclasses import dataclass
-from ase.db import connect
-from collections import defaultdict
-import numpy as np
-
-def cumulative_average(quantity):
-    """Return the cumulative average of quantity."""
-    return np.cumsum(quantity) / np.arange(1, len(quantity) + 1)
+from dipole_aimd.analysis.engine import AnalysisEngine, CumulativeAverage, RawSeries, cumulative_average
 
 @dataclass
 class ParseEnergy:
@@ -15,56 +8,41 @@ class ParseEnergy:
     Inputs
     ------
     ase_db_file: str
-        The path to the ASE database file.
+        The path to the ASE database file, a glob pattern or a list of databases to merge.
     output_file: str
-        The path to the output json file.
+        The path to the output json file, or numpy archive if it ends with .npz.
+    state: str
+        Only parse the rows of this state, all states if None.
+    run_numbers: tuple
+        Inclusive (min, max) range of run numbers to parse, either can be None.
+    timesteps: tuple
+        Inclusive (min, max) range of timesteps to parse, either can be None.
+    workers: int
+        Number of processes reading the databases and reducing the states.
     """
     ase_db_file: str
     output_file: str
     output_file_raw: str
+    state: str = None
+    run_numbers: tuple = None
+    timesteps: tuple = None
+    workers: int = 1
 
     def __post_init__(self):
-        self.energy = defaultdict(list)
-        self._energy = defaultdict(list)
-        self.parse_energy()
-        self.store_energy()
-    
-    def get_ase_database(self):
-        """Read the ASE database and yield the dipole moment."""
-        with connect(self.ase_db_file) as handle:
-            for row in handle.select():
-                # Consider only the dipole moment along the z-axis
-                if row.get('energy') is not None:
-                    yield row.energy, row.run_number, row.timestep, row.state
-
-    def parse_energy(self):
-        """Store the energy and the structure in a dict of lists in sorted order of sampling."""
-        for energy, run_number, timestep, state in self.get_ase_database():
-            self._energy[state].append(np.array([run_number, timestep, energy]))
-    
-    def store_energy(self):
-        """Store the energy from the collected data."""
-        # Sort the energy based on the sampling for each structure
-        for structure, energy_data in self._energy.items():
-            energy_data = np.array(energy_data)
-            sorted_index = np.lexsort((energy_data[:, 0], energy_data[:, 1]))
-            self.energy[structure].append(energy_data[sorted_index]) 
-
-        # Store the quantities for later use
-        self.avg_energy = defaultdict(list)
-        self.raw_energy = defaultdict(list)
+        self.run()
 
-        # Find the cumulative average of the energy
-        for structure, data in self.energy.items():
-            _, _, energy = np.array(data).T
-            raw_energy = np.array(energy).flatten()
-            energy_average = cumulative_average(energy)
-            time_in_ps = np.arange(0, len(energy_average), 1) * 0.001
-            self.raw_energy[structure] = [time_in_ps.tolist(), raw_energy.tolist()]
-            self.avg_energy[structure] = [time_in_ps.tolist(), energy_average.tolist()]
+    def get_engine(self):
+        """Engine computing the cumulative average and the raw energy in the same pass."""
+        engine = AnalysisEngine(self.ase_db_file, state=self.state,
+                                run_numbers=self.run_numbers, timesteps=self.timesteps, workers=self.workers)
+        self.average = engine.add(CumulativeAverage('energy', self.output_file))
+        self.raw = engine.add(RawSeries('energy', self.output_file_raw))
+        return engine
 
-        # Save the file as a json
-        with open(self.output_file, 'w') as handle:
-            json.dump(self.avg_energy, handle)
-        with open(self.output_file_raw,'w') as handle:
-            json.dump(self.raw_energy, handle)
+    def run(self):
+        """Store the cumulative average and the raw energy of the different structures as json."""
+        self.get_engine().run()
+        # Sorted run number, timestep and energy of every structure
+        self.energy = self.average.sorted
+        self.avg_energy = self.average.result
+        self.raw_energy = self.raw.result
@@ -0,0 +1,201 @@
+"""Autocorrelation function and IR spectrum of the dipole moment coming from an AIMD calculation."""
+import json
+from dataclasses import dataclass
+import numpy as np
+from ase.units import _c
+from dipole_aimd.analysis.engine import AnalysisEngine, Observable, select_quantity
+from dipole_aimd.analysis.output import is_npz_file, write_npz
+
+# Windows applied to the autocorrelation function before the Fourier transform
+WINDOWS = {
+    None: np.ones,
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+}
+
+def autocorrelation(series, max_lag=None):
+    """Return the unnormalised sums of x(t) x(t + lag) and the number of pairs for every lag.
+
+    The sums are computed with a zero padded FFT in O(N log N) instead of a loop
+    over lags, and are returned separately from the number of pairs so that the
+    autocorrelation of several runs can be combined.
+    """
+    series = np.asarray(series, dtype=np.float64)
+    nsamples = len(series)
+    if max_lag is None or max_lag > nsamples - 1:
+        max_lag = nsamples - 1
+    # Padding to at least twice the length avoids the circular correlation
+    nfft = 1 << int(np.ceil(np.log2(2 * nsamples - 1))) if nsamples > 1 else 1
+    transform = np.fft.rfft(series, n=nfft)
+    sums = np.fft.irfft(transform * transform.conj(), n=nfft)[:max_lag + 1]
+    counts = nsamples - np.arange(max_lag + 1)
+    return sums, counts
+
+def get_window(window, length):
+    """Return the decaying half of a symmetric window, one value for every lag."""
+    if window not in WINDOWS:
+        raise ValueError(f'Unknown window {window}, choose from {list(WINDOWS)}.')
+    return WINDOWS[window](2 * length - 1)[length - 1:]
+
+def power_spectrum(acf, timestep_fs, window='hann'):
+    """Return the frequencies in cm^-1 and the power spectrum of an autocorrelation function.
+
+    The windowed autocorrelation function is mirrored to negative lags, so that its
+    Fourier transform is real.
+    """
+    acf = acf * get_window(window, len(acf))
+    symmetric = np.concatenate([acf, acf[-2:0:-1]])
+    spectrum = np.fft.rfft(symmetric).real * timestep_fs
+    # Frequencies in 1/fs converted to wavenumbers
+    frequencies = np.fft.rfftfreq(len(symmetric), d=timestep_fs) * 1e15 / (_c * 100)
+    return frequencies, spectrum
+
+@dataclass
+class DipoleSpectrum(Observable):
+    """Autocorrelation function, power spectrum and IR spectrum of the dipole moment.
+
+    The autocorrelation function is computed for every run of a structure from the
+    fluctuations of the dipole moment around the mean of the run, and the runs are
+    combined by weighting every lag with its number of pairs. The IR spectrum is
+    the power spectrum multiplied by the squared frequency, in arbitrary units.
+    Inputs
+    ------
+    output_file: str
+        The path to the output file, a json file or, if it ends with .npz, a numpy
+        archive; nothing is written if None.
+    components: str
+        The components of the dipole moment that are summed in the autocorrelation function.
+    timestep_fs: float
+        The time between two frames in fs.
+    max_lag: int
+        The largest lag of the autocorrelation function in frames, all lags if None.
+    window: str
+        The window applied to the autocorrelation function: hann, hamming, blackman or None.
+    """
+    output_file: str = None
+    components: str = 'z'
+    timestep_fs: float = 1.0
+    max_lag: int = None
+    window: str = 'hann'
+    results = ('autocorrelation', 'spectrum')
+
+    def __post_init__(self):
+        get_window(self.window, 1)
+        self.quantities = tuple('dipole_' + component for component in self.components)
+        self.autocorrelation = {}
+        self.spectrum = {}
+
+    def get_autocorrelation(self, run_number, timestep, values):
+        """Return the autocorrelation function combined over the runs and components."""
+        sums = np.zeros(0)
+        counts = np.zeros(0)
+        for quantity in self.quantities:
+            component_run_number, _, dipole = select_quantity(run_number, timestep, values, quantity)
+            # The frames are sorted by timestep, a stable sort groups them by run
+            order = np.argsort(component_run_number, kind='stable')
+            component_run_number, dipole = component_run_number[order], dipole[order]
+            boundaries = np.flatnonzero(np.diff(component_run_number)) + 1
+            for run_dipole in np.split(dipole, boundaries):
+                if not len(run_dipole):
+                    continue
+                run_sums, run_counts = autocorrelation(run_dipole - run_dipole.mean(), self.max_lag)
+                if len(run_sums) > len(sums):
+                    sums = np.pad(sums, (0, len(run_sums) - len(sums)))
+                    counts = np.pad(counts, (0, len(run_counts) - len(counts)))
+                sums[:len(run_sums)] += run_sums
+                counts[:len(run_counts)] += run_counts
+        if not len(sums):
+            return None
+        # Every component adds the same number of pairs
+        return sums / counts * len(self.quantities)
+
+    def reduce(self, structure, run_number, timestep, values):
+        acf = self.get_autocorrelation(run_number, timestep, values)
+        if acf is None:
+            return
+        frequencies, power = power_spectrum(acf, self.timestep_fs, self.window)
+        time_in_ps = np.arange(len(acf)) * self.timestep_fs * 0.001
+        self.autocorrelation[structure] = [time_in_ps, acf]
+        self.spectrum[structure] = [frequencies, power, frequencies**2 * power]
+
+    def write(self):
+        if self.output_file is None:
+            return
+        structures = list(self.autocorrelation)
+        if is_npz_file(self.output_file):
+            arrays = {}
+            for structure in structures:
+                time_in_ps, acf = self.autocorrelation[structure]
+                frequencies, power, infrared = self.spectrum[structure]
+                arrays.update({f'{structure}/time': time_in_ps, f'{structure}/autocorrelation': acf,
+                               f'{structure}/frequency': frequencies, f'{structure}/power': power,
+                               f'{structure}/infrared': infrared})
+            write_npz(self.output_file, arrays, {'observable': type(self).__name__, 'components': self.components,
+                                                 'timestep_fs': self.timestep_fs, 'max_lag': self.max_lag,
+                                                 'window': self.window, 'structures': structures})
+        else:
+            output = {structure: {'time': self.autocorrelation[structure][0].tolist(),
+                                  'autocorrelation': self.autocorrelation[structure][1].tolist(),
+                                  'frequency': self.spectrum[structure][0].tolist(),
+                                  'power': self.spectrum[structure][1].tolist(),
+                                  'infrared': self.spectrum[structure][2].tolist()}
+                      for structure in structures}
+            with open(self.output_file, 'w') as handle:
+                json.dump(output, handle)
+
+@dataclass
+class ParseSpectrum:
+    """Parses the ASE database for the autocorrelation function and the IR spectrum of the dipole moment.
+
+    See DipoleSpectrum for how the spectra are computed.
+    Inputs
+    ------
+    ase_db_file: str
+        The path to the ASE database file, a glob pattern or a list of databases to merge.
+    output_file: str
+        The path to the output file, a json file or, if it ends with .npz, a numpy archive.
+    components: str
+        The components of the dipole moment that are summed in the autocorrelation function.
+    timestep_fs: float
+        The time between two frames in fs.
+    max_lag: int
+        The largest lag of the autocorrelation function in frames, all lags if None.
+    window: str
+        The window applied to the autocorrelation function: hann, hamming, blackman or None.
+    state: str
+        Only parse the rows of this state, all states if None.
+    run_numbers: tuple
+        Inclusive (min, max) range of run numbers to parse, either can be None.
+    timesteps: tuple
+        Inclusive (min, max) range of timesteps to parse, either can be None.
+    workers: int
+        Number of processes reading the databases and reducing the states.
+    """
+    ase_db_file: str
+    output_file: str
+    components: str = 'z'
+    timestep_fs: float = 1.0
+    max_lag: int = None
+    window: str = 'hann'
+    state: str = None
+    run_numbers: tuple = None
+    timesteps: tuple = None
+    workers: int = 1
+
+    def __post_init__(self):
+        self.run()
+
+    def get_engine(self):
+        """Engine computing the spectra of the dipole moment."""
+        engine = AnalysisEngine(self.ase_db_file, state=self.state,
+                                run_numbers=self.run_numbers, timesteps=self.timesteps, workers=self.workers)
+        self.dipole_spectrum = engine.add(DipoleSpectrum(self.output_file, self.components, self.timestep_fs,
+                                                         self.max_lag, self.window))
+        return engine
+
+    def run(self):
+        """Store the autocorrelation function and the spectra of every structure."""
+        self.get_engine().run()
+        self.autocorrelation = self.dipole_spectrum.autocorrelation
+        self.spectrum = self.dipole_spectrum.spectrum
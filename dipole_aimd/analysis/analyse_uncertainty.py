@@ -0,0 +1,177 @@
+"""Estimate the statistical uncertainty of the dipole moment and the energy of an AIMD calculation."""
+import json
+from dataclasses import dataclass
+import numpy as np
+from dipole_aimd.analysis.engine import AnalysisEngine, Observable, select_quantity
+from dipole_aimd.analysis.output import is_npz_file, write_npz
+
+# Results of the blocking analysis with a value for every level
+BLOCK_ARRAYS = ('block_size', 'block_standard_error', 'block_standard_error_error')
+
+def block_averages(series, block_size):
+    """Return the averages of consecutive blocks of block_size values; the remainder is dropped."""
+    series = np.asarray(series, dtype=np.float64)
+    nblocks = len(series) // block_size
+    return series[:nblocks * block_size].reshape(nblocks, block_size).mean(axis=1)
+
+def blocking_analysis(series):
+    """Standard error of the mean of a correlated series versus the block size.
+
+    Flyvbjerg and Petersen, J. Chem. Phys. 91, 461 (1989): the series is
+    repeatedly replaced by the averages of pairs of neighbouring values, and the
+    standard error is computed from the variance of the block averages at every
+    level. Every level halves the data, so the whole analysis is O(N).
+
+    Returns the block sizes, the standard errors and the errors of the standard errors.
+    """
+    blocks = np.asarray(series, dtype=np.float64)
+    block_sizes = []
+    errors = []
+    error_of_errors = []
+    block_size = 1
+    while len(blocks) >= 2:
+        nblocks = len(blocks)
+        error = np.sqrt(np.var(blocks) / (nblocks - 1))
+        block_sizes.append(block_size)
+        errors.append(error)
+        error_of_errors.append(error / np.sqrt(2 * (nblocks - 1)))
+        blocks = 0.5 * (blocks[0:nblocks - nblocks % 2:2] + blocks[1::2])
+        block_size *= 2
+    return np.array(block_sizes), np.array(errors), np.array(error_of_errors)
+
+def find_plateau(errors, error_of_errors, min_blocks_level=None):
+    """Index of the first level from which the standard error no longer grows.
+
+    That is the first level whose standard error agrees with that of the next
+    level within its error; if there is none, the level with the largest error.
+    The levels after min_blocks_level are not considered, since they have too
+    few blocks to estimate a variance.
+    """
+    nlevels = len(errors) if min_blocks_level is None else min(min_blocks_level + 1, len(errors))
+    if nlevels == 0:
+        return None
+    for level in range(nlevels - 1):
+        if errors[level + 1] - errors[level] < error_of_errors[level]:
+            return level
+    return int(np.argmax(errors[:nlevels]))
+
+def inefficiency_from_blocking(nsamples, variance, errors, error_of_errors):
+    """Return the statistical inefficiency and the standard error from the levels of a blocking analysis."""
+    if nsamples < 2:
+        return np.nan, np.nan
+    # Keep at least 16 blocks for the variance of the block averages
+    min_blocks_level = max(int(np.log2(nsamples / 16)), 0)
+    error = errors[find_plateau(errors, error_of_errors, min_blocks_level)]
+    if variance == 0:
+        return 1.0, 0.0
+    return nsamples * error**2 / variance, error
+
+def statistical_inefficiency(series):
+    """Return the statistical inefficiency of a series and the standard error of its mean.
+
+    The statistical inefficiency s is the number of steps between effectively
+    uncorrelated samples, s = N * error^2 / variance, where the error is taken
+    from the plateau of the blocking analysis.
+    """
+    series = np.asarray(series, dtype=np.float64)
+    if len(series) < 2:
+        return np.nan, np.nan
+    _, errors, error_of_errors = blocking_analysis(series)
+    return inefficiency_from_blocking(len(series), np.var(series), errors, error_of_errors)
+
+@dataclass
+class BlockingUncertainty(Observable):
+    """Mean, standard error and statistical inefficiency of a quantity from a blocking analysis.
+    Inputs
+    ------
+    quantity: str
+        energy, or one of the components of the dipole: dipole_x, dipole_y, dipole_z.
+    output_file: str
+        The path to the output file, a json file or, if it ends with .npz, a numpy
+        archive with the levels of every structure as arrays and the rest in the
+        metadata; nothing is written if None.
+    """
+    quantity: str
+    output_file: str = None
+    results = ('result',)
+
+    def __post_init__(self):
+        self.quantities = (self.quantity,)
+        self.result = {}
+
+    def reduce(self, structure, run_number, timestep, values):
+        _, _, series = select_quantity(run_number, timestep, values, self.quantity)
+        if not len(series):
+            return
+        block_sizes, errors, error_of_errors = blocking_analysis(series)
+        inefficiency, error = inefficiency_from_blocking(len(series), np.var(series), errors, error_of_errors)
+        self.result[structure] = {
+            'nsamples': len(series),
+            'mean': float(np.mean(series)),
+            'standard_error': float(error),
+            'statistical_inefficiency': float(inefficiency),
+            'block_size': block_sizes.tolist(),
+            'block_standard_error': errors.tolist(),
+            'block_standard_error_error': error_of_errors.tolist(),
+        }
+
+    def write(self):
+        if self.output_file is None:
+            return
+        if is_npz_file(self.output_file):
+            arrays = {f'{structure}/{name}': np.asarray(result[name])
+                      for structure, result in self.result.items() for name in BLOCK_ARRAYS}
+            summary = {structure: {name: value for name, value in result.items() if name not in BLOCK_ARRAYS}
+                       for structure, result in self.result.items()}
+            write_npz(self.output_file, arrays, {'observable': type(self).__name__, 'quantity': self.quantity,
+                                                 'structures': list(self.result), 'summary': summary})
+            return
+        with open(self.output_file, 'w') as handle:
+            json.dump(self.result, handle)
+
+@dataclass
+class ParseUncertainty:
+    """Parses the ASE database for the uncertainty of the mean of the dipole moment or the energy.
+
+    For every state the mean, the standard error from a blocking analysis, the
+    statistical inefficiency and the standard error versus the block size are
+    stored in a json file.
+    Inputs
+    ------
+    ase_db_file: str
+        The path to the ASE database file, a glob pattern or a list of databases to merge.
+    output_file: str
+        The path to the output json file, or numpy archive if it ends with .npz.
+    quantity: str
+        energy, or one of the components of the dipole: dipole_x, dipole_y, dipole_z.
+    state: str
+        Only parse the rows of this state, all states if None.
+    run_numbers: tuple
+        Inclusive (min, max) range of run numbers to parse, either can be None.
+    timesteps: tuple
+        Inclusive (min, max) range of timesteps to parse, either can be None.
+    workers: int
+        Number of processes reading the databases and reducing the states.
+    """
+    ase_db_file: str
+    output_file: str
+    quantity: str = 'dipole_z'
+    state: str = None
+    run_numbers: tuple = None
+    timesteps: tuple = None
+    workers: int = 1
+
+    def __post_init__(self):
+        self.run()
+
+    def get_engine(self):
+        """Engine computing the blocking analysis of the quantity."""
+        engine = AnalysisEngine(self.ase_db_file, state=self.state,
+                                run_numbers=self.run_numbers, timesteps=self.timesteps, workers=self.workers)
+        self.blocking = engine.add(BlockingUncertainty(self.quantity, self.output_file))
+        return engine
+
+    def run(self):
+        """Store the blocking analysis of the quantity, in the same order of sampling as the averages."""
+        self.get_engine().run()
+        self.uncertainty = self.blocking.result
@@ -0,0 +1,330 @@
+"""Read a single quantity from the databases written by the parser."""
+import glob
+import os
+import os.path as op
+import sqlite3
+import numpy as np
+from ase.db import connect
+from dipole_aimd.parser.parser_dipole import is_sqlite_file, add_range, get_conditions
+from dipole_aimd.parser.parser_scalars import is_scalars_database
+from dipole_aimd.parser.parser_compact import is_compact_database
+from dipole_aimd.parser.array_store import is_array_store, iter_array_store
+
+# Probes for keys stored in the other table than select_ase_database reads them
+# from, e.g. a numeric state is stored by ASE in number_key_values
+MISTYPED_KEYS = (
+    "SELECT 1 FROM number_key_values WHERE key = 'state' LIMIT 1",
+    "SELECT 1 FROM text_key_values WHERE key IN ('run_number', 'timestep') LIMIT 1",
+)
+
+def has_typed_keys(filename):
+    """Check if the state of every row of an ASE SQLite database is text and its run_number and timestep numbers.
+
+    Only then can the keys be read by select_ase_database. The probes are served
+    by the indices on the key of the key-value tables, so they do not scan the
+    database. The parser writes the three keys for every row.
+    """
+    connection = sqlite3.connect(filename)
+    try:
+        return not any(connection.execute(probe).fetchone() for probe in MISTYPED_KEYS)
+    except sqlite3.OperationalError:
+        # Not an ASE database, e.g. an empty file
+        return False
+    finally:
+        connection.close()
+
+def get_dipole_component(quantity):
+    """Index of the component of the dipole moment, e.g. 2 for dipole_z."""
+    return 'xyz'.index(quantity[-1])
+
+def select_ase_database(filename, quantities, state=None, run_numbers=None, timesteps=None, ids=None):
+    """Yield the quantities, run_number, timestep and state of the rows of an ASE SQLite database.
+
+    Only the energy and dipole columns needed and the three keys are read, and the
+    selection is done in SQL, instead of building an AtomsRow for every row.
+    """
+    columns = []
+    if 'energy' in quantities:
+        columns.append('energy')
+    if any(quantity != 'energy' for quantity in quantities):
+        columns.append('dipole')
+    conditions, args = get_conditions('state.value', 'run.value', 'step.value', state, run_numbers, timesteps)
+    add_range(conditions, args, 'systems.id', ids)
+    conditions.insert(0, '(' + ' OR '.join(f'systems.{column} IS NOT NULL' for column in columns) + ')')
+    sql = f"""SELECT {', '.join('systems.' + column for column in columns)}, run.value, step.value, state.value
+    FROM systems
+    JOIN text_key_values AS state ON state.id = systems.id AND state.key = 'state'
+    JOIN number_key_values AS run ON run.id = systems.id AND run.key = 'run_number'
+    JOIN number_key_values AS step ON step.id = systems.id AND step.key = 'timestep'
+    WHERE {' AND '.join(conditions)}
+    ORDER BY systems.id"""
+    # Position of every quantity in the selected row, and the component of the dipole
+    getters = [(columns.index('energy'), None) if quantity == 'energy'
+               else (columns.index('dipole'), get_dipole_component(quantity)) for quantity in quantities]
+    connection = sqlite3.connect(filename)
+    try:
+        for row in connection.execute(sql, args):
+            values = []
+            for index, component in getters:
+                value = row[index]
+                if component is not None and value is not None:
+                    # ASE stores the dipole as the raw float64 buffer
+                    value = float(np.frombuffer(value, dtype=np.float64)[component])
+                values.append(value)
+            yield tuple(values), int(row[-3]), int(row[-2]), row[-1]
+    finally:
+        connection.close()
+
+def select_scalars(filename, quantities, state=None, run_numbers=None, timesteps=None, ids=None):
+    """Yield the quantities, run_number, timestep and state of the rows of a --scalars-only database."""
+    conditions, args = get_conditions('state', 'run_number', 'timestep', state, run_numbers, timesteps)
+    add_range(conditions, args, 'id', ids)
+    conditions.insert(0, '(' + ' OR '.join(f'{quantity} IS NOT NULL' for quantity in quantities) + ')')
+    sql = f"""SELECT {', '.join(quantities)}, run_number, timestep, state FROM scalars
+    WHERE {' AND '.join(conditions)} ORDER BY id"""
+    nquantities = len(quantities)
+    connection = sqlite3.connect(filename)
+    try:
+        for row in connection.execute(sql, args):
+            yield row[:nquantities], row[-3], row[-2], row[-1]
+    finally:
+        connection.close()
+
+def select_compact(filename, quantities, state=None, run_numbers=None, timesteps=None, ids=None):
+    """Yield the quantities, run_number, timestep and state of the frames of a --compact database."""
+    conditions, args = get_conditions('runs.state', 'runs.run_number', 'frames.timestep', state, run_numbers, timesteps)
+    add_range(conditions, args, 'frames.id', ids)
+    conditions.insert(0, '(' + ' OR '.join(f'frames.{quantity} IS NOT NULL' for quantity in quantities) + ')')
+    sql = f"""SELECT {', '.join('frames.' + quantity for quantity in quantities)}, runs.run_number, frames.timestep, runs.state
+    FROM frames JOIN runs ON runs.id = frames.run_id
+    WHERE {' AND '.join(conditions)} ORDER BY frames.id"""
+    nquantities = len(quantities)
+    connection = sqlite3.connect(filename)
+    try:
+        for row in connection.execute(sql, args):
+            yield row[:nquantities], row[-3], row[-2], row[-1]
+    finally:
+        connection.close()
+
+def select_rows(filename, quantities, state=None, run_numbers=None, timesteps=None, ids=None):
+    """Yield the quantities of the rows of any ASE database through ase.db."""
+    selection = []
+    for key, bounds in (('run_number', run_numbers), ('timestep', timesteps), ('id', ids)):
+        if bounds is not None:
+            if bounds[0] is not None:
+                selection.append(f'{key}>={bounds[0]}')
+            if bounds[1] is not None:
+                selection.append(f'{key}<={bounds[1]}')
+    kwargs = {} if state is None else {'state': state}
+    with connect(filename) as handle:
+        for row in handle.select(','.join(selection) or None, include_data=False, **kwargs):
+            values = []
+            for quantity in quantities:
+                if quantity == 'energy':
+                    values.append(row.get('energy'))
+                else:
+                    dipole = row.get('dipole')
+                    values.append(None if dipole is None else dipole[get_dipole_component(quantity)])
+            if all(value is None for value in values):
+                continue
+            yield tuple(values), row.run_number, row.timestep, row.state
+
+def iter_quantities(filename, quantities, state=None, run_numbers=None, timesteps=None, ids=None):
+    """Yield the quantities, run_number, timestep and state of every frame that has any of the quantities.
+
+    The quantities are read in a single pass over the database; a quantity that a
+    frame does not have is None, or nan for an --array-store.
+    Inputs
+    ------
+    filename: str
+        An ASE database, a database written with --scalars-only or --compact,
+        or the folder of an --array-store.
+    quantities: tuple
+        Any of energy and the components of the dipole: dipole_x, dipole_y, dipole_z.
+    state: str
+        Only the frames of this state, all states if None.
+    run_numbers: tuple
+        Inclusive (min, max) of the run numbers, either of which can be None.
+    timesteps: tuple
+        Inclusive (min, max) of the timesteps, either of which can be None.
+    ids: tuple
+        Inclusive (min, max) of the database ids, either of which can be None;
+        not available for an --array-store.
+    """
+    quantities = tuple(quantities)
+    selection = dict(state=state, run_numbers=run_numbers, timesteps=timesteps)
+    if is_array_store(filename):
+        if ids is not None:
+            raise ValueError('An --array-store has no ids to select frames by.')
+        for values, run_number, timestep, run_state in iter_array_store(filename, quantities, **selection):
+            for frame_values, frame_run_number, step in zip(values.tolist(), run_number.tolist(), timestep.tolist()):
+                yield tuple(frame_values), frame_run_number, step, run_state
+    elif op.isdir(filename):
+        raise ValueError(f'{filename} is a folder but not an --array-store.')
+    elif is_scalars_database(filename):
+        yield from select_scalars(filename, quantities, ids=ids, **selection)
+    elif is_compact_database(filename):
+        yield from select_compact(filename, quantities, ids=ids, **selection)
+    elif is_sqlite_file(filename) and has_typed_keys(filename):
+        yield from select_ase_database(filename, quantities, ids=ids, **selection)
+    else:
+        # Rows with keys of other types are read through ase.db, which converts them back
+        yield from select_rows(filename, quantities, ids=ids, **selection)
+
+def get_last_id(filename):
+    """Return the largest id of the rows of a database, 0 if it is empty."""
+    if is_scalars_database(filename):
+        table = 'scalars'
+    elif is_compact_database(filename):
+        table = 'frames'
+    elif is_sqlite_file(filename):
+        table = 'systems'
+    else:
+        with connect(filename) as handle:
+            return max((row.id for row in handle.select(include_data=False)), default=0)
+    connection = sqlite3.connect(filename)
+    try:
+        return connection.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+    finally:
+        connection.close()
+
+def get_database_files(databases):
+    """Return the paths of a database, a glob pattern of databases or a list of either.
+
+    The databases matched by a pattern are sorted by name, and a database listed
+    twice is only returned once.
+    """
+    if isinstance(databases, (str, os.PathLike)):
+        databases = [databases]
+    filenames = []
+    for pattern in map(os.fspath, databases):
+        if op.exists(pattern) or not glob.has_magic(pattern):
+            matches = [pattern]
+        else:
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise FileNotFoundError(f'No database matches {pattern}.')
+        for filename in matches:
+            if filename not in filenames:
+                filenames.append(filename)
+    return filenames
+
+def iter_quantity(filename, quantity, state=None, run_numbers=None, timesteps=None):
+    """Yield the quantity, run_number, timestep and state of every frame that has the quantity.
+
+    See iter_quantities for the inputs.
+    """
+    for values, run_number, timestep, row_state in iter_quantities(
+            filename, (quantity,), state=state, run_numbers=run_numbers, timesteps=timesteps):
+        yield values[0], run_number, timestep, row_state
+
+class ColumnBuffer:
+    """Typed arrays of run_number, timestep and value that grow in chunks.
+
+    Rows are written in place into preallocated arrays, whose capacity is doubled
+    when they are full, so that collecting a quantity does not keep a python
+    object per row. With a width, every row has width values, e.g. one for every
+    quantity read in the same pass.
+    """
+
+    def __init__(self, capacity=1024, width=None):
+        self.size = 0
+        self.width = width
+        self.run_number = np.empty(capacity, dtype=np.int64)
+        self.timestep = np.empty(capacity, dtype=np.int64)
+        self.value = np.empty(self.get_shape(capacity), dtype=np.float64)
+
+    def get_shape(self, capacity):
+        """Shape of the values for a capacity."""
+        return capacity if self.width is None else (capacity, self.width)
+
+    def reserve(self, size):
+        """Grow the arrays, at least doubling their capacity, so that they hold size rows."""
+        if size <= len(self.value):
+            return
+        capacity = max(2 * len(self.value), size, 1024)
+        self.run_number = np.resize(self.run_number, capacity)
+        self.timestep = np.resize(self.timestep, capacity)
+        self.value = np.resize(self.value, self.get_shape(capacity))
+
+    def append(self, value, run_number, timestep):
+        """Add a single row."""
+        if self.size == len(self.value):
+            self.reserve(self.size + 1)
+        self.run_number[self.size] = run_number
+        self.timestep[self.size] = timestep
+        self.value[self.size] = value
+        self.size += 1
+
+    def extend_columns(self, value, run_number, timestep):
+        """Add a block of rows given as arrays of the values, run_number and timestep."""
+        end = self.size + len(timestep)
+        self.reserve(end)
+        self.run_number[self.size:end] = run_number
+        self.timestep[self.size:end] = timestep
+        self.value[self.size:end] = value
+        self.size = end
+
+    def trim(self):
+        """Drop the unused capacity, e.g. before sending the buffer to another process."""
+        self.run_number = self.run_number[:self.size].copy()
+        self.timestep = self.timestep[:self.size].copy()
+        self.value = self.value[:self.size].copy()
+
+    def extend(self, other):
+        """Add the rows of another buffer after those of this one."""
+        self.run_number = np.concatenate([self.run_number[:self.size], other.run_number[:other.size]])
+        self.timestep = np.concatenate([self.timestep[:self.size], other.timestep[:other.size]])
+        self.value = np.concatenate([self.value[:self.size], other.value[:other.size]])
+        self.size += other.size
+
+    def sorted(self, unique=False):
+        """Return run_number, timestep and value sorted by timestep and then run_number.
+
+        With unique, only the first row added of every run_number and timestep is kept.
+        """
+        run_number = self.run_number[:self.size]
+        timestep = self.timestep[:self.size]
+        sorted_index = np.lexsort((run_number, timestep))
+        if unique and len(sorted_index):
+            # lexsort is stable, so the duplicates are in the order they were added
+            sorted_run_number = run_number[sorted_index]
+            sorted_timestep = timestep[sorted_index]
+            first = np.ones(len(sorted_index), dtype=bool)
+            first[1:] = (np.diff(sorted_timestep) != 0) | (np.diff(sorted_run_number) != 0)
+            sorted_index = sorted_index[first]
+        return run_number[sorted_index], timestep[sorted_index], self.value[:self.size][sorted_index]
+
+def collect_columns(rows, width=None):
+    """Collect rows of (value, run_number, timestep, state) into a ColumnBuffer per state.
+
+    With a width, the value of every row is a sequence of width values, where None
+    is stored as nan.
+    """
+    columns = {}
+    for value, run_number, timestep, state in rows:
+        buffer = columns.get(state)
+        if buffer is None:
+            buffer = columns[state] = ColumnBuffer(width=width)
+        buffer.append(value, run_number, timestep)
+    return columns
+
+def collect_quantities(filename, quantities, state=None, run_numbers=None, timesteps=None, ids=None):
+    """Read the quantities of a database into a ColumnBuffer per state, with a column per quantity.
+
+    The runs of an --array-store are added as whole columns rather than row by
+    row. See iter_quantities for the inputs.
+    """
+    quantities = tuple(quantities)
+    selection = dict(state=state, run_numbers=run_numbers, timesteps=timesteps)
+    if not is_array_store(filename):
+        return collect_columns(iter_quantities(filename, quantities, ids=ids, **selection), width=len(quantities))
+    if ids is not None:
+        raise ValueError('An --array-store has no ids to select frames by.')
+    columns = {}
+    for value, run_number, timestep, run_state in iter_array_store(filename, quantities, **selection):
+        buffer = columns.get(run_state)
+        if buffer is None:
+            buffer = columns[run_state] = ColumnBuffer(width=len(quantities))
+        buffer.extend_columns(value, run_number, timestep)
+    return columns
@@ -0,0 +1,218 @@
+"""Analyse several quantities of an AIMD calculation in a single pass over the database."""
+import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import repeat
+import numpy as np
+from dipole_aimd.analysis.database import collect_quantities, get_database_files
+from dipole_aimd.analysis.output import is_npz_file, write_npz, get_run_layout
+
+def cumulative_average(quantity):
+    """Return the cumulative average of quantity."""
+    return np.cumsum(quantity) / np.arange(1, len(quantity) + 1)
+
+def select_quantity(run_number, timestep, values, quantity):
+    """Return run_number, timestep and values of the quantity for the frames that have it."""
+    value = values[quantity]
+    mask = ~np.isnan(value)
+    return run_number[mask], timestep[mask], value[mask]
+
+class Observable:
+    """Base class of the observables computed by the AnalysisEngine.
+
+    An observable lists the quantities it needs, gets the sorted columns of every
+    structure through reduce, and writes its output once all structures are done.
+    results names the dictionaries of the outputs per structure, which merge
+    collects from the copies of the observable that reduced structures in other
+    processes.
+    """
+    quantities = ()
+    results = ()
+
+    def reduce(self, structure, run_number, timestep, values):
+        """Reduce the frames of a structure, sorted by timestep and run_number.
+
+        values is a dict of the arrays of every quantity read, nan where a frame
+        does not have the quantity.
+        """
+        raise NotImplementedError
+
+    def merge(self, other):
+        """Add the outputs of the structures reduced by a copy of the observable."""
+        for name in self.results:
+            getattr(self, name).update(getattr(other, name))
+
+    def write(self):
+        """Write the output of the observable."""
+
+@dataclass
+class CumulativeAverage(Observable):
+    """Cumulative average of a quantity versus the time in ps.
+    Inputs
+    ------
+    quantity: str
+        energy, or one of the components of the dipole: dipole_x, dipole_y, dipole_z.
+    output_file: str
+        The path to the output file, a json file or, if it ends with .npz, a numpy
+        archive; nothing is written if None.
+    timestep_fs: float
+        The time between two frames in fs.
+    """
+    quantity: str
+    output_file: str = None
+    timestep_fs: float = 1.0
+    results = ('sorted', 'series', 'result')
+    # Name of the series in a numpy archive
+    series_name = 'cumulative_average'
+
+    def __post_init__(self):
+        self.quantities = (self.quantity,)
+        self.sorted = {}
+        self.series = {}
+        self.result = {}
+
+    def get_series(self, value):
+        """The series stored for a structure."""
+        return cumulative_average(value)
+
+    def reduce(self, structure, run_number, timestep, values):
+        run_number, timestep, value = select_quantity(run_number, timestep, values, self.quantity)
+        if not len(value):
+            return
+        self.sorted[structure] = (run_number, timestep, value)
+        series = self.get_series(value)
+        self.series[structure] = series
+        time_in_ps = np.arange(0, len(series), 1) * (self.timestep_fs * 0.001)
+        self.result[structure] = [time_in_ps.tolist(), series.tolist()]
+
+    def write_npz(self):
+        """Write the series of every structure as float64 arrays, with its run_number and timestep as int32.
+
+        The time is not stored, it is the index of the series times timestep_fs
+        from the metadata, which also has the frames of every run of a structure.
+        """
+        arrays = {}
+        runs = {}
+        for structure, series in self.series.items():
+            run_number, timestep, _ = self.sorted[structure]
+            arrays.update({f'{structure}/{self.series_name}': series,
+                           f'{structure}/run_number': run_number.astype(np.int32),
+                           f'{structure}/timestep': timestep.astype(np.int32)})
+            runs[structure] = get_run_layout(run_number)
+        write_npz(self.output_file, arrays, {'observable': type(self).__name__, 'quantity': self.quantity,
+                                             'series': self.series_name, 'timestep_fs': self.timestep_fs,
+                                             'structures': list(self.series), 'runs': runs})
+
+    def write(self):
+        if self.output_file is None:
+            return
+        if is_npz_file(self.output_file):
+            self.write_npz()
+            return
+        with open(self.output_file, 'w') as handle:
+            json.dump(self.result, handle)
+
+@dataclass
+class RawSeries(CumulativeAverage):
+    """Values of a quantity versus the time in ps, in the order of sampling."""
+    series_name = 'value'
+
+    def get_series(self, value):
+        return value
+
+def read_columns(filename, quantities, selection):
+    """Read the quantities of a database into a ColumnBuffer per structure."""
+    columns = collect_quantities(filename, quantities, **selection)
+    for buffer in columns.values():
+        buffer.trim()
+    return columns
+
+def merge_columns(columns_per_database):
+    """Merge the columns of every structure, in the order of the databases."""
+    merged = {}
+    for columns in columns_per_database:
+        for structure, buffer in columns.items():
+            if structure in merged:
+                merged[structure].extend(buffer)
+            else:
+                merged[structure] = buffer
+    return merged
+
+def reduce_structure(observables, quantities, structure, buffer, unique=False):
+    """Sort the frames of a structure and reduce them with every observable, which are returned."""
+    run_number, timestep, value = buffer.sorted(unique)
+    values = {quantity: value[:, index] for index, quantity in enumerate(quantities)}
+    for observable in observables:
+        observable.reduce(structure, run_number, timestep, values)
+    return observables
+
+@dataclass
+class AnalysisEngine:
+    """Read the frames of a database once and feed them to any number of observables.
+
+    The quantities needed by all the observables are read in a single pass, collected
+    per structure, sorted by timestep and run_number and handed to every observable.
+    Nothing is read before run is called.
+
+    Several databases, e.g. one per ingest node, are merged as if they were one:
+    the rows are read in the order of the databases and only the first frame of
+    every state, run_number and timestep is kept. With workers, the databases are
+    read and the structures sorted and reduced in a process pool, so that the
+    observables have to be picklable; the outputs are the same as with one process.
+    Inputs
+    ------
+    ase_db_file: str
+        The path to the ASE database file, a --scalars-only or --compact database
+        or an --array-store; a glob pattern or a list of several of these.
+    observables: list
+        The observables to compute.
+    state: str
+        Only parse the rows of this state, all states if None.
+    run_numbers: tuple
+        Inclusive (min, max) range of run numbers to parse, either can be None.
+    timesteps: tuple
+        Inclusive (min, max) range of timesteps to parse, either can be None.
+    """
+    ase_db_file: str
+    observables: list = field(default_factory=list)
+    state: str = None
+    run_numbers: tuple = None
+    timesteps: tuple = None
+    workers: int = 1
+
+    def add(self, observable):
+        """Add an observable and return it."""
+        self.observables.append(observable)
+        return observable
+
+    def get_quantities(self):
+        """The quantities needed by the observables, each listed once."""
+        quantities = []
+        for observable in self.observables:
+            for quantity in observable.quantities:
+                if quantity not in quantities:
+                    quantities.append(quantity)
+        return quantities
+
+    def run(self):
+        """Read the databases, reduce every structure with every observable and write the outputs."""
+        quantities = self.get_quantities()
+        filenames = get_database_files(self.ase_db_file)
+        selection = dict(state=self.state, run_numbers=self.run_numbers, timesteps=self.timesteps)
+        # A single database is analysed as it is, duplicates are only dropped when merging
+        unique = len(filenames) > 1
+        if self.workers <= 1:
+            columns = merge_columns(read_columns(filename, quantities, selection) for filename in filenames)
+            for structure, buffer in columns.items():
+                reduce_structure(self.observables, quantities, structure, buffer, unique)
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                columns = merge_columns(executor.map(read_columns, filenames, repeat(quantities), repeat(selection)))
+                # Every structure is reduced by copies of the observables, whose outputs are merged back
+                for reduced in executor.map(reduce_structure, repeat(self.observables), repeat(quantities),
+                                            columns.keys(), columns.values(), repeat(unique)):
+                    for observable, copy in zip(self.observables, reduced):
+                        observable.merge(copy)
+        for observable in self.observables:
+            observable.write()
+        return self.observables
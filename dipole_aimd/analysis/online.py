@@ -0,0 +1,242 @@
+"""Follow the dipole moment and the energy of running AIMD jobs, reading only the new frames."""
+import json
+import os
+import os.path as op
+import time
+from dataclasses import dataclass, field, asdict
+import click
+import numpy as np
+from dipole_aimd.analysis.database import collect_quantities, get_last_id
+from dipole_aimd.analysis.analyse_uncertainty import inefficiency_from_blocking
+from dipole_aimd.parser.readers import tail_trajectory, get_compression
+
+@dataclass
+class RunningMean:
+    """Running mean and variance, updated with batches of new values.
+
+    Welford's update generalised to batches (Chan et al.), so that an update only
+    costs the number of new values.
+    """
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+
+    def update(self, values):
+        """Add a batch of values."""
+        values = np.asarray(values, dtype=np.float64)
+        count = len(values)
+        if not count:
+            return
+        mean = float(values.mean())
+        m2 = float(np.sum((values - mean)**2))
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+
+    @property
+    def variance(self):
+        """Variance of the values added so far."""
+        return self.m2 / self.count if self.count else np.nan
+
+@dataclass
+class OnlineBlocking:
+    """Blocking analysis updated with batches of new values.
+
+    Every level keeps the running variance of its block averages and the block
+    average that still waits for its pair, so that the levels are the same as those
+    of blocking_analysis of the whole series, at O(new values) per update.
+    """
+    levels: list = field(default_factory=list)
+    pending: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restore the saved state."""
+        return cls([RunningMean(**level) for level in data['levels']], data['pending'])
+
+    @property
+    def total(self):
+        """Running mean and variance of all the values."""
+        return self.levels[0] if self.levels else RunningMean()
+
+    def update(self, values):
+        """Add a batch of values in the order of sampling."""
+        values = np.asarray(values, dtype=np.float64)
+        level = 0
+        while len(values):
+            if level == len(self.levels):
+                self.levels.append(RunningMean())
+                self.pending.append(None)
+            self.levels[level].update(values)
+            if self.pending[level] is not None:
+                values = np.concatenate([[self.pending[level]], values])
+            npairs = len(values) // 2
+            self.pending[level] = float(values[-1]) if len(values) % 2 else None
+            values = 0.5 * (values[0:2 * npairs:2] + values[1:2 * npairs:2])
+            level += 1
+
+    def get_errors(self):
+        """Return the block sizes, the standard errors and the errors of the standard errors."""
+        block_sizes = []
+        errors = []
+        error_of_errors = []
+        for level, stats in enumerate(self.levels):
+            if stats.count < 2:
+                break
+            error = np.sqrt(stats.variance / (stats.count - 1))
+            block_sizes.append(2**level)
+            errors.append(error)
+            error_of_errors.append(error / np.sqrt(2 * (stats.count - 1)))
+        return np.array(block_sizes), np.array(errors), np.array(error_of_errors)
+
+@dataclass
+class OnlineAnalysis:
+    """Cumulative averages and uncertainties that continue from a saved state.
+
+    New frames are read by tailing growing OUTCAR/vasprun.xml files from the offset
+    of the last complete frame, or from the rows of a database above the last id
+    seen. The running statistics of every state and quantity are saved in a json
+    file after every update, and the new points of the cumulative averages are
+    appended to a json-lines file, one line per state and quantity.
+    Inputs
+    ------
+    state_file: str
+        The path to the json file with the saved state, created if it does not exist.
+    output_file: str
+        The path to the json-lines output, nothing is written if None.
+    quantities: tuple
+        Any of energy and the components of the dipole: dipole_x, dipole_y, dipole_z.
+    """
+    state_file: str
+    output_file: str = None
+    quantities: tuple = ('dipole_z', 'energy')
+
+    def __post_init__(self):
+        self.offsets = {}
+        self.last_ids = {}
+        self.last_frames = {}
+        self.blocking = {}
+        if op.exists(self.state_file):
+            with open(self.state_file, 'r') as handle:
+                saved = json.load(handle)
+            self.offsets = saved['offsets']
+            self.last_ids = saved['last_ids']
+            self.last_frames = saved.get('last_frames', {})
+            self.blocking = {state: {quantity: OnlineBlocking.from_dict(data) for quantity, data in blocking.items()}
+                             for state, blocking in saved['blocking'].items()}
+
+    def save(self):
+        """Write the state atomically so that an interrupted update does not corrupt it."""
+        saved = {'offsets': self.offsets, 'last_ids': self.last_ids, 'last_frames': self.last_frames,
+                 'blocking': {state: {quantity: asdict(data) for quantity, data in blocking.items()}
+                              for state, blocking in self.blocking.items()}}
+        tmp_filename = self.state_file + '.tmp'
+        with open(tmp_filename, 'w') as handle:
+            json.dump(saved, handle)
+        os.replace(tmp_filename, self.state_file)
+
+    def update(self, state, values):
+        """Add the new frames of a state and return a record for every quantity.
+
+        values maps every quantity to the array of its new values in the order of
+        sampling, nan where a frame does not have the quantity.
+        """
+        records = []
+        for quantity in self.quantities:
+            value = np.asarray(values[quantity], dtype=np.float64)
+            value = value[~np.isnan(value)]
+            if not len(value):
+                continue
+            blocking = self.blocking.setdefault(state, {}).setdefault(quantity, OnlineBlocking())
+            # Continue the cumulative average from the frames already seen
+            count, mean = blocking.total.count, blocking.total.mean
+            average = (count * mean + np.cumsum(value)) / (count + np.arange(1, len(value) + 1))
+            time_in_ps = np.arange(count, count + len(value)) * 0.001
+            blocking.update(value)
+            _, errors, error_of_errors = blocking.get_errors()
+            inefficiency, error = inefficiency_from_blocking(blocking.total.count, blocking.total.variance,
+                                                             errors, error_of_errors)
+            records.append({'state': state, 'quantity': quantity,
+                            'time': time_in_ps.tolist(), 'cumulative_average': average.tolist(),
+                            'nsamples': blocking.total.count, 'mean': blocking.total.mean,
+                            'standard_error': float(error), 'statistical_inefficiency': float(inefficiency)})
+        if self.output_file is not None and records:
+            with open(self.output_file, 'a') as handle:
+                for record in records:
+                    handle.write(json.dumps(record) + '\n')
+        return records
+
+    def update_from_file(self, filename, state):
+        """Add the frames written to an OUTCAR or vasprun.xml file since the last update."""
+        offset = self.offsets.get(filename, 0)
+        # The offsets of a compressed file are those of the decompressed text
+        if not get_compression(filename) and os.stat(filename).st_size < offset:
+            raise ValueError(f'{filename} is shorter than when it was last read, remove {self.state_file} to start over.')
+        frames = list(tail_trajectory(filename, offset))
+        if not frames:
+            return []
+        energy, _, dipole, offsets = zip(*frames)
+        dipole = np.array([components if components is not None else [np.nan] * 3 for components in dipole])
+        values = {'energy': np.array(energy), 'dipole_x': dipole[:, 0],
+                  'dipole_y': dipole[:, 1], 'dipole_z': dipole[:, 2]}
+        records = self.update(state, values)
+        self.offsets[filename] = offsets[-1]
+        self.save()
+        return records
+
+    def update_from_database(self, dbname, state=None, run_numbers=None, timesteps=None):
+        """Add the rows of a database with ids above the last id seen.
+
+        The rows are added in the order in which they arrive in the database: only
+        the new rows of every state are sorted by timestep and run_number. If a new
+        row sorts before the last one added for its state, for example when an
+        earlier run is stored after a later one, the cumulative averages differ from
+        those of ParseDipole and ParseEnergy and a warning is printed.
+        """
+        last_seen = self.last_ids.get(dbname, 0)
+        last_id = get_last_id(dbname)
+        if last_id <= last_seen:
+            return []
+        columns = collect_quantities(dbname, self.quantities, state=state, run_numbers=run_numbers,
+                                     timesteps=timesteps, ids=(last_seen + 1, last_id))
+        records = []
+        for structure, buffer in columns.items():
+            run_number, timestep, value = buffer.sorted()
+            if structure in self.last_frames and [int(timestep[0]), int(run_number[0])] < self.last_frames[structure]:
+                print(f'Warning: {dbname} has frames of {structure} before the last frame added, '
+                      f'the averages are in the order of arrival rather than of timestep and run_number.')
+            self.last_frames[structure] = [int(timestep[-1]), int(run_number[-1])]
+            records.extend(self.update(structure, {quantity: value[:, index]
+                                                   for index, quantity in enumerate(self.quantities)}))
+        self.last_ids[dbname] = last_id
+        self.save()
+        return records
+
+def is_trajectory_file(path):
+    """Check if the path is an OUTCAR or vasprun.xml file rather than a database."""
+    basename = op.basename(path)
+    return '.xml' in basename or 'OUTCAR' in basename
+
+@click.command()
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--state-file', default='online_state.json', help='Json file with the state saved between updates.')
+@click.option('--output', default='online.jsonl', help='Json-lines file the new averages are appended to.')
+@click.option('--state', default=None, help='State of the frames of OUTCAR/vasprun.xml files, their folder name by default.')
+@click.option('--interval', default=60., type=float, help='Seconds between updates, a single update if 0.')
+def follow(paths, state_file, output, state, interval):
+    """Follows the dipole moment and the energy of OUTCAR/vasprun.xml files or databases as they grow."""
+    analysis = OnlineAnalysis(state_file, output)
+    while True:
+        for path in paths:
+            if is_trajectory_file(path):
+                records = analysis.update_from_file(path, state or op.basename(op.dirname(op.abspath(path))))
+            else:
+                records = analysis.update_from_database(path, state=state)
+            for record in records:
+                print(f"{record['state']} {record['quantity']}: {record['nsamples']} frames, "
+                      f"mean {record['mean']:.6f} +/- {record['standard_error']:.6f}")
+        if not interval:
+            break
+        time.sleep(interval)
@@ -0,0 +1,67 @@
+"""Write the results of the analysis as numpy archives and load them memory-mapped."""
+import json
+import struct
+import zipfile
+import numpy as np
+
+# Name of the json metadata in an archive; the arrays are named structure/array
+METADATA = 'metadata'
+
+# Readers of the header of a .npy file for every version of the format
+HEADER_READERS = {
+    (1, 0): np.lib.format.read_array_header_1_0,
+    (2, 0): np.lib.format.read_array_header_2_0,
+}
+
+def is_npz_file(filename):
+    """Check if the results are written as a numpy archive rather than as json."""
+    return filename.endswith('.npz')
+
+def get_run_layout(run_number):
+    """Return the run numbers and the number of frames of every run, as lists of [run_number, frames]."""
+    runs, counts = np.unique(run_number, return_counts=True)
+    return [[int(run), int(count)] for run, count in zip(runs, counts)]
+
+def write_npz(filename, arrays, metadata):
+    """Write the arrays and json metadata as an uncompressed numpy archive.
+
+    The archive is not compressed, so that load_npz can memory-map its arrays.
+    """
+    np.savez(filename, **{METADATA: np.array(json.dumps(metadata))}, **arrays)
+
+def get_data_offset(handle, info):
+    """Return the offset of the data of a .npy member of an uncompressed archive, and its header."""
+    handle.seek(info.header_offset)
+    # The local header of the member has a variable length name and extra field
+    name_length, extra_length = struct.unpack('<HH', handle.read(30)[26:30])
+    handle.seek(info.header_offset + 30 + name_length + extra_length)
+    version = np.lib.format.read_magic(handle)
+    if version not in HEADER_READERS:
+        return None, None
+    header = HEADER_READERS[version](handle)
+    return handle.tell(), header
+
+def load_npz(filename, mmap_mode='r'):
+    """Return the metadata and the arrays of an archive written by write_npz.
+
+    The arrays are memory-mapped with mmap_mode, so that only the parts of a
+    series that are used are read from disk; with mmap_mode None, or for members
+    that cannot be mapped, they are read into memory.
+    """
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as handle:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            offset = None
+            if mmap_mode is not None and info.compress_type == zipfile.ZIP_STORED:
+                offset, header = get_data_offset(handle, info)
+            if offset is not None:
+                shape, fortran_order, dtype = header
+                if shape and not dtype.hasobject and np.prod(shape) > 0:
+                    arrays[name] = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape,
+                                             order='F' if fortran_order else 'C')
+                    continue
+            with archive.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member)
+    metadata = json.loads(str(arrays.pop(METADATA))) if METADATA in arrays else {}
+    return metadata, arrays
@@ -1,55 +1,289 @@
 """Create structures that have random positions of the cation in an AIMD calculation."""
 
+import hashlib
+import itertools
 import os
 import sys
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import yaml
+import click
 from dataclasses import dataclass
 from ase import atom, build
 from ase import constraints
 from ase import Atoms
 from ase import data
+from ase.io import read, write
 from pathlib import Path
-from copy import deepcopy
+from scipy.spatial import cKDTree
 
-def get_random_xy_positions(cell, n_atoms):
+def get_random_xy_positions(cell, n_atoms, rng=np.random):
     """Get random xy positions for the cation."""
-    x_chosen = np.random.uniform(0, np.linalg.norm(cell[0]), n_atoms)
-    y_chosen = np.random.uniform(0, np.linalg.norm(cell[1]), n_atoms)
+    x_chosen = rng.uniform(0, np.linalg.norm(cell[0]), n_atoms)
+    y_chosen = rng.uniform(0, np.linalg.norm(cell[1]), n_atoms)
     return x_chosen, y_chosen
 
-def check_xy_distance(test_atoms, cutoff_fraction):
-    """Check if the xy positions are too close to each other."""
-    for i in range(len(test_atoms)):
-        for j in range(i+1, len(test_atoms)):
-            # required minimum distance is the sum of the covalent radii
-            min_cutoff = data.covalent_radii[data.atomic_numbers[test_atoms[i].symbol]] + \
-                            data.covalent_radii[data.atomic_numbers[test_atoms[j].symbol]]
-            # Reduce the min cutoff by the cutoff fraction
-            min_cutoff = min_cutoff * cutoff_fraction
-            # if np.linalg.norm(test_atoms.get_positions()[i] - test_atoms.get_positions()[j]) < min_cutoff:
-            if test_atoms.get_distance(i,j, mic=True) < min_cutoff:
-                return False
-    return True
-
-def add_natoms_to_surface(surface, n_atoms, atoms_all, x_chosen, y_chosen, z_chosen):
-    """For a given number of atoms, and Atoms extend the original atoms object"""
-    for j, n_atom in enumerate(range(n_atoms)):
-        atoms_to_extend = atoms_all[j]
-        # Standardize the positions
-        atoms_to_extend.set_cell([1, 1, 1])
-        atoms_to_extend.center()
-        atoms_to_extend.set_cell([0, 0, 0])
-        atoms_to_extend.rotate('y', np.random.uniform(0, 360), center='COU')
-        atoms_to_extend.translate([[x_chosen[j], y_chosen[j], z_chosen]])
-
-        # Rotate the molecule randomly
-        surface.extend(atoms_to_extend)
+def get_cutoff_radii(numbers, cutoff_fraction):
+    """Covalent radii of the atoms scaled by the cutoff fraction."""
+    return data.covalent_radii[np.asarray(numbers)] * cutoff_fraction
+
+def get_image_shifts(cell, pbc, cutoff):
+    """Cartesian shifts of all the periodic images that can be within cutoff of the cell."""
+    cell = np.asarray(cell)
+    volume = abs(np.linalg.det(cell))
+    ranges = []
+    for axis in range(3):
+        if not pbc[axis] or volume == 0:
+            ranges.append([0])
+            continue
+        # Distance between the planes of the cell perpendicular to the other two axes
+        height = volume / np.linalg.norm(np.cross(cell[axis - 2], cell[axis - 1]))
+        repeats = int(np.ceil(cutoff / height))
+        ranges.append(range(-repeats, repeats + 1))
+    shifts = np.array(np.meshgrid(*ranges, indexing='ij')).reshape(3, -1).T
+    return shifts @ cell
+
+class OverlapChecker:
+    """Find pairs of atoms closer than the scaled sum of their covalent radii.
+
+    The atoms that do not move, e.g. the slab and the layers that are already
+    placed, are put in a KD-tree together with their periodic images once, so
+    that only the newly placed atoms have to be tested, against the fixed atoms
+    and against each other.
+    """
+
+    def __init__(self, atoms, cutoff_fraction):
+        self.cell = atoms.get_cell().array
+        self.pbc = atoms.get_pbc()
+        self.cutoff_fraction = cutoff_fraction
+        self.nfixed = len(atoms)
+        self.radii = get_cutoff_radii(atoms.numbers, cutoff_fraction)
+        self.max_radius = self.radii.max() if self.nfixed else 0.
+        self.tree = None
+        if self.nfixed:
+            # The largest cutoff is that of the largest fixed atom with the largest element
+            shifts = get_image_shifts(self.cell, self.pbc, self.max_radius + data.covalent_radii.max() * cutoff_fraction)
+            self.indices = np.tile(np.arange(self.nfixed), len(shifts))
+            positions = self.wrap(atoms.positions)
+            self.tree = cKDTree((positions[None, :, :] + shifts[:, None, :]).reshape(-1, 3))
+
+    def wrap(self, positions):
+        """Return the positions wrapped into the cell along the periodic axes."""
+        if not self.pbc.any() or np.linalg.det(self.cell) == 0:
+            return positions
+        scaled = np.linalg.solve(self.cell.T, positions.T).T
+        scaled[:, self.pbc] %= 1
+        return scaled @ self.cell
+
+    def find_overlaps(self, positions, numbers):
+        """Return the pairs (i, j), i < j, of overlapping atoms, of which j is a new atom.
+
+        The new atoms are numbered after the fixed atoms, in the same way as in the
+        atoms object of the fixed atoms extended by the new ones.
+        """
+        positions = self.wrap(np.asarray(positions, dtype=float).reshape(-1, 3))
+        radii = get_cutoff_radii(numbers, self.cutoff_fraction)
+        pairs = [np.empty((0, 2), dtype=int)]
+        if not len(positions):
+            return pairs[0]
+        new_tree = cKDTree(positions)
+        if self.tree is not None:
+            distances = self.tree.sparse_distance_matrix(new_tree, self.max_radius + radii.max(), output_type='ndarray')
+            fixed = self.indices[distances['i']]
+            mask = distances['v'] < self.radii[fixed] + radii[distances['j']]
+            pairs.append(np.column_stack([fixed[mask], self.nfixed + distances['j'][mask]]))
+        # The new atoms with each other, including their periodic images
+        shifts = get_image_shifts(self.cell, self.pbc, 2 * radii.max())
+        indices = np.tile(np.arange(len(positions)), len(shifts))
+        image_tree = cKDTree((positions[None, :, :] + shifts[:, None, :]).reshape(-1, 3))
+        distances = image_tree.sparse_distance_matrix(new_tree, 2 * radii.max(), output_type='ndarray')
+        first, second = indices[distances['i']], distances['j']
+        mask = (first < second) & (distances['v'] < radii[first] + radii[second])
+        pairs.append(np.column_stack([self.nfixed + first[mask], self.nfixed + second[mask]]))
+        return np.unique(np.concatenate(pairs), axis=0)
+
+def get_centered_geometry(molecule):
+    """Positions of a molecule with the centre of its bounding box at (0.5, 0.5, 0.5).
+
+    These are the positions that place_molecules rotates and translates.
+    """
+    positions = molecule.get_positions()
+    return positions - (positions.min(axis=0) + positions.max(axis=0)) / 2 + 0.5
+
+def get_y_rotations(angles):
+    """Rotation matrices about the y-axis for angles in degrees."""
+    angles = np.radians(angles)
+    rotations = np.zeros((len(angles), 3, 3))
+    rotations[:, 0, 0] = rotations[:, 2, 2] = np.cos(angles)
+    rotations[:, 0, 2] = np.sin(angles)
+    rotations[:, 2, 0] = -np.sin(angles)
+    rotations[:, 1, 1] = 1
+    return rotations
+
+def place_molecules(geometry, molecule_index, angles, x_chosen, y_chosen, z_chosen):
+    """Rotate every molecule about the y-axis and translate it to its xy position at z_chosen.
+
+    geometry holds the centered positions of the atoms of all molecules and
+    molecule_index the molecule of every atom, so that all molecules are placed at
+    once.
+    """
+    rotations = get_y_rotations(angles)[molecule_index]
+    translations = np.column_stack([x_chosen, y_chosen, np.full(len(x_chosen), z_chosen)])[molecule_index]
+    return np.einsum('nij,nj->ni', rotations, geometry) + translations
+
+def allocate_folder(prefix, index=1):
+    """Create and return the first folder prefix_<index> that does not exist yet.
+
+    os.mkdir fails if the folder already exists, so that runs started at the same
+    time never get the same folder.
+    """
+    while True:
+        folder = f'{prefix}_{index}'
+        try:
+            os.mkdir(folder)
+            return folder
+        except FileExistsError:
+            index += 1
+
+def get_seed_info(seed):
+    """The seed in a form that can be stored in a yaml file and passed to numpy again."""
+    if isinstance(seed, np.random.SeedSequence):
+        return {'entropy': seed.entropy, 'spawn_key': list(seed.spawn_key)}
+    return seed
+
+def build_slab(metal_name, a, facet, metal_layers, dimensions, vacuum):
+    """Build the surface with the bottom half of the atoms tagged 1, at the bottom of the cell."""
+    # create the bulk structure
+    bulk = build.bulk(metal_name, 'fcc', a=a, cubic=True)
+
+    # create the surface
+    miller_indices = [int(index) for index in facet]
+    surface = build.surface(bulk, indices=miller_indices, layers=metal_layers)
+
+    # Repeat the structure
+    surface.center(vacuum=vacuum, axis=2)
+    surface = surface.repeat([dimensions[0], dimensions[1], 1])
+
+    # fix the bottom half of the surface
+    all_z_index = surface.get_positions()[:, 2]
+    all_index = np.arange(len(all_z_index))
+    mean_z_index = np.mean(all_z_index)
+    bottom_z_index = all_index[all_z_index < mean_z_index]
+
+    # Set the tag to 1 for things that we want to fix
+    tags = surface.get_tags()
+    tags[bottom_z_index] = 1
+    surface.set_tags(tags)
+
+    # Move the surface to the bottom of the cell
+    surface.translate([[0, 0, -np.min(all_z_index)]])
+    return surface
+
+# Inputs of the yaml file that define the slab, in the order of the arguments of build_slab
+SLAB_INPUTS = ('metal_name', 'a', 'facet', 'metal_layers', 'dimensions', 'vacuum')
+
+def get_slab_key(metal_name, a, facet, metal_layers, dimensions, vacuum):
+    """The inputs of build_slab in a form that can be used as the key of a SlabCache."""
+    return (str(metal_name), float(a), str(facet), int(metal_layers),
+            tuple(int(dimension) for dimension in dimensions), float(vacuum))
+
+@dataclass
+class SlabCache:
+    """Memoize the slabs built by build_slab.
+
+    The slabs are kept in memory, and optionally in a folder as trajectory files
+    so that they are shared between processes and runs. Both stores evict the
+    least recently used slabs beyond their maximum size. A copy of the slab is
+    returned, so that the cached slab is never modified.
+    Inputs
+    ------
+    maxsize: int
+        The number of slabs kept in memory.
+    path: str
+        The folder of the on-disk store, no on-disk store if None.
+    max_disk_entries: int
+        The number of slabs kept in the on-disk store.
+    """
+    maxsize: int = 32
+    path: str = None
+    max_disk_entries: int = 256
+
+    def __post_init__(self):
+        self.slabs = OrderedDict()
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    def get_filename(self, key):
+        """File of the slab in the on-disk store."""
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + '.traj')
+
+    def get(self, key):
+        """Return a copy of the slab of key = get_slab_key(...), building it if needed."""
+        if key in self.slabs:
+            self.slabs.move_to_end(key)
+            return self.slabs[key].copy()
+        surface = None
+        if self.path is not None:
+            filename = self.get_filename(key)
+            if os.path.exists(filename):
+                surface = read(filename)
+                # Mark the slab as recently used
+                os.utime(filename)
+        if surface is None:
+            surface = build_slab(*key)
+            if self.path is not None:
+                self.store(filename, surface)
+        self.slabs[key] = surface
+        if len(self.slabs) > self.maxsize:
+            self.slabs.popitem(last=False)
+        return surface.copy()
+
+    def store(self, filename, surface):
+        """Write a slab to the on-disk store and evict the least recently used slabs."""
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        write(tmp_filename, surface, format='traj')
+        os.replace(tmp_filename, filename)
+        filenames = [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith('.traj')]
+        if len(filenames) > self.max_disk_entries:
+            filenames.sort(key=os.path.getmtime)
+            for old_filename in filenames[:len(filenames) - self.max_disk_entries]:
+                try:
+                    os.remove(old_filename)
+                except FileNotFoundError:
+                    # Evicted by another process at the same time
+                    pass
+
+# Slabs shared by the CreateCation runs of a process, per on-disk store
+_SLAB_CACHES = {}
+
+def get_slab_cache(path=None):
+    """Return the SlabCache of the process for an on-disk store, only in memory if path is None."""
+    if path not in _SLAB_CACHES:
+        _SLAB_CACHES[path] = SlabCache(path=path)
+    return _SLAB_CACHES[path]
 
 @dataclass
 class CreateCation:
-    """Create structures with cations within a cell of given dimensions."""
+    """Create structures with cations within a cell of given dimensions.
+    Inputs
+    ------
+    yaml_file: str
+        The path to the yaml file with the inputs.
+    parameters: dict
+        Inputs that replace those of the yaml file.
+    seed: int
+        Seed, numpy SeedSequence or the seed stored in inputs.yaml, of the random
+        positions and angles; the global numpy random state is used if None.
+    slab_cache: SlabCache
+        Cache of the slabs, or the path of its on-disk store; the in-memory
+        cache of the process if None.
+    """
     yaml_file: str
+    parameters: dict = None
+    seed: object = None
+    slab_cache: object = None
 
     def __post_init__(self):
         """Initialize class."""
@@ -57,6 +291,17 @@ class CreateCation:
         # Check if all of the tags are available, and if there
         # is more or less it raises and exception.
         inputs = yaml.safe_load(open(self.yaml_file))
+        if self.parameters:
+            unknown = set(self.parameters) - set(inputs) - {'adsorbate'}
+            if unknown:
+                raise ValueError(f'Unknown parameters {sorted(unknown)}, not in {self.yaml_file}.')
+            inputs.update(self.parameters)
+        self.inputs = dict(inputs)
+        if isinstance(self.seed, dict):
+            self.seed = np.random.SeedSequence(self.seed['entropy'], spawn_key=self.seed['spawn_key'])
+        self.rng = np.random if self.seed is None else np.random.default_rng(self.seed)
+        if not isinstance(self.slab_cache, SlabCache):
+            self.slab_cache = get_slab_cache(self.slab_cache)
 
         # get the facet
         self.facet = inputs['facet']
@@ -94,33 +339,12 @@ class CreateCation:
 
     def create_surface(self):
         """Create the surface and fix half the layers."""
-        # create the bulk structure
-        bulk = build.bulk(self.metal_name, 'fcc', a=self.a, cubic=True)
-
-        # create the surface
-        miller_indices = [int(a) for a in self.facet]
-        surface = build.surface(bulk, indices=miller_indices, layers=self.metal_layers)
-
-        # Repeat the structure
         self.dimensions = [int(a) for a in self.dimensions]
-        surface.center(vacuum=self.vacuum, axis=2)
-        surface = surface.repeat([self.dimensions[0], self.dimensions[1], 1])
-
-        # fix the bottom half of the surface
-        all_z_index = surface.get_positions()[:, 2]
-        all_index = np.arange(len(all_z_index))
-        mean_z_index = np.mean(all_z_index)
-        bottom_z_index = all_index[all_z_index < mean_z_index]
-
-        # Set the tag to 1 for things that we want to fix
-        for index_fixed in bottom_z_index:
-            surface[index_fixed].tag = 1
+        key = get_slab_key(self.metal_name, self.a, self.facet, self.metal_layers, self.dimensions, self.vacuum)
+        surface = self.slab_cache.get(key)
 
         # Store the position of the topmost metal atom 
-        self.top_metal_atom = all_index[np.argmax(all_z_index)]
-
-        # Move the surface to the bottom of the cell
-        surface.translate([[0, 0, -np.min(all_z_index)]])
+        self.top_metal_atom = int(np.argmax(surface.get_positions()[:, 2]))
 
         # store the surface
         self.surface = surface
@@ -171,59 +395,145 @@ class CreateCation:
             # Find the number of atoms placed in a layer
             n_atoms = self.water_per_layer
             if self.layer_of_cation == layer:
-                atoms_all = [deepcopy(water) for n_atom in range(n_atoms-1)]
-                atoms_all += [cation]
+                atoms_all = [water] * (n_atoms - 1) + [cation]
             else:
-                atoms_all = [deepcopy(water) for n_atom in range(n_atoms)]
+                atoms_all = [water] * n_atoms
+
+            # The positions of the molecules are only built as arrays until they fit
+            symbols = [symbol for molecule in atoms_all for symbol in molecule.get_chemical_symbols()]
+            numbers = np.concatenate([molecule.numbers for molecule in atoms_all])
+            geometry = np.concatenate([get_centered_geometry(molecule) for molecule in atoms_all])
+            molecule_index = np.repeat(np.arange(n_atoms), [len(molecule) for molecule in atoms_all])
 
             # Decide on the z-coordinate of the water
             z_chosen = z_min + i * self.water_layer_distance
-            x_chosen, y_chosen = get_random_xy_positions(self.surface.cell, n_atoms)
-
-            # Create a copy of the atoms object to test if the xy positions are too close
-            test_atoms = deepcopy(self.surface)
+            x_chosen, y_chosen = get_random_xy_positions(self.surface.cell, n_atoms, self.rng)
+            angles = self.rng.uniform(0, 360, n_atoms)
 
-            # Add the atoms to the test_atoms
-            add_natoms_to_surface(test_atoms, n_atoms, atoms_all, x_chosen, y_chosen, z_chosen)
+            # The surface and the layers below do not move, only the new atoms are checked
+            checker = OverlapChecker(self.surface, self.cutoff_fraction)
+            nfixed = len(self.surface)
 
             # Check if the xy positions are too close
             iteration = 0
-            while not check_xy_distance(test_atoms, cutoff_fraction = self.cutoff_fraction):
-                # The atoms are too close to each other, change the angles
+            while True:
+                positions = place_molecules(geometry, molecule_index, angles, x_chosen, y_chosen, z_chosen)
+                pairs = checker.find_overlaps(positions, numbers) - nfixed
+                # The atoms of a molecule are not tested against each other
+                new_pairs = pairs[:, 0] >= 0
+                same_molecule = np.zeros(len(pairs), dtype=bool)
+                same_molecule[new_pairs] = molecule_index[pairs[new_pairs, 0]] == molecule_index[pairs[new_pairs, 1]]
+                pairs = pairs[~same_molecule]
+                if not len(pairs):
+                    break
+                # The atoms are too close to each other, change the angles of the molecules
+                # that clash, keeping the first of two new molecules that clash
                 iteration += 1
                 print(f'Iteration {iteration}')
-                # Try again, with a changed angle
-                test_atoms = deepcopy(self.surface)
-                add_natoms_to_surface(test_atoms, n_atoms, atoms_all, x_chosen, y_chosen, z_chosen)
+                clashing = np.unique(molecule_index[pairs[:, 1]])
+                angles[clashing] = self.rng.uniform(0, 360, len(clashing))
                 if iteration > 100:
-                    # Create a new set of atoms
-                    test_atoms = deepcopy(self.surface)
-                    x_chosen, y_chosen = get_random_xy_positions(self.surface.cell, n_atoms)
-                    add_natoms_to_surface(test_atoms, n_atoms, atoms_all, x_chosen, y_chosen, z_chosen)
+                    # Choose new xy positions for these molecules
+                    x_new, y_new = get_random_xy_positions(self.surface.cell, len(clashing), self.rng)
+                    x_chosen[clashing] = x_new
+                    y_chosen[clashing] = y_new
                 if iteration > 200:
                     # Give up
                     raise Exception('Too many iterations')
 
             print(f'Chosen z-positions {z_chosen} AA')
-            self.surface = test_atoms
+            self.surface.extend(Atoms(symbols, positions=positions))
 
     def create_pre_relaxation_structures(self):
         """Create folder structure"""
         self.constrain_atoms()
-        index = 1
         no_water = self.water_layers * self.water_per_layer - 1
         if self.adsorbate:
             self.metal_name = self.metal_name + '_' + self.adsorbate
-        state_info = self.metal_name + '_' + self.facet + '_' + self.cation + '_' + str(self.dimensions[0]) + 'x' + str(self.dimensions[1]) + '_' + 'cationlayer_' + str(self.layer_of_cation) + '_' + str(no_water) + 'w_' + str(index)
+        state_info = self.metal_name + '_' + self.facet + '_' + self.cation + '_' + str(self.dimensions[0]) + 'x' + str(self.dimensions[1]) + '_' + 'cationlayer_' + str(self.layer_of_cation) + '_' + str(no_water) + 'w'
 
-        while os.path.exists(state_info):
-            index += 1
-            state_info = self.metal_name + '_' + self.facet + '_' + self.cation + '_' + str(self.dimensions[0]) + 'x' + str(self.dimensions[1]) + '_' + 'cationlayer_' + str(self.layer_of_cation) + '_' + str(no_water) + 'w_' + str(index)
-
-        folder = os.path.join(os.getcwd(), state_info, 'pre_relaxation')
+        folder = os.path.join(allocate_folder(os.path.join(os.getcwd(), state_info)), 'pre_relaxation')
         Path(folder).mkdir(parents=True, exist_ok=True)
         self.folder = folder
 
         # Write the atoms object to that folder
         self.surface.set_pbc([True, True, True])
-        self.surface.write(os.path.join(self.folder, 'pre_relaxation.traj'),)
\ No newline at end of file
+        self.surface.write(os.path.join(self.folder, 'pre_relaxation.traj'),)
+
+        # Store the inputs and the seed needed to create the same structure again
+        with open(os.path.join(self.folder, 'inputs.yaml'), 'w') as handle:
+            yaml.safe_dump(dict(self.inputs, seed=get_seed_info(self.seed)), handle)
+
+def get_parameter_grid(grid):
+    """Return a dict of parameters for every combination of the values in grid."""
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+def create_single_cation(yaml_file, parameters, seed, slab_cache=None):
+    """Create a single structure and return its folder."""
+    return CreateCation(yaml_file, parameters=parameters, seed=seed, slab_cache=slab_cache).folder
+
+def create_cation_batch(yaml_file, grid=None, count=1, seed=None, workers=1, slab_cache=None):
+    """Create count structures for every combination of the parameters in grid.
+
+    Every structure gets its own seed spawned from seed, so that the structures
+    are statistically independent and the batch can be created again with the
+    same seed, regardless of the number of workers. Every slab is built once,
+    before the structures are created in parallel. The folders of the structures
+    are returned in the order of the grid.
+    Inputs
+    ------
+    yaml_file: str
+        The path to the yaml file with the inputs.
+    grid: dict
+        Lists of values of the inputs that replace those of the yaml file.
+    count: int
+        The number of structures for every combination of the parameters.
+    seed: int
+        The seed of the whole batch, a random one if None.
+    workers: int
+        The number of processes creating the structures.
+    slab_cache: str
+        The folder of an on-disk SlabCache, kept between batches.
+    """
+    tasks = [parameters for parameters in get_parameter_grid(grid or {}) for _ in range(count)]
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    if workers <= 1:
+        return [create_single_cation(yaml_file, parameters, task_seed, slab_cache)
+                for parameters, task_seed in zip(tasks, seeds)]
+    with tempfile.TemporaryDirectory() as tmp_path:
+        # The workers read the slabs from an on-disk store instead of each building them
+        path = slab_cache if slab_cache is not None else tmp_path
+        cache = SlabCache(path=path)
+        inputs = yaml.safe_load(open(yaml_file))
+        for parameters in get_parameter_grid(grid or {}):
+            slab_inputs = dict(inputs, **parameters)
+            cache.get(get_slab_key(*(slab_inputs[name] for name in SLAB_INPUTS)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(create_single_cation, itertools.repeat(yaml_file), tasks, seeds,
+                                     itertools.repeat(path)))
+
+def parse_grid_option(yaml_file, options):
+    """Parse the key=value1,value2 options of the grid, with the types of the yaml file."""
+    inputs = yaml.safe_load(open(yaml_file))
+    grid = {}
+    for option in options:
+        key, _, values = option.partition('=')
+        if not values:
+            raise click.BadParameter(f'{option} is not of the form key=value1,value2.')
+        # Keep strings such as the facet '111' as strings
+        convert = str if isinstance(inputs.get(key), str) else yaml.safe_load
+        grid[key] = [convert(value) for value in values.split(',')]
+    return grid
+
+@click.command()
+@click.argument('yaml_file')
+@click.option('--grid', multiple=True, help='Values of an input to create structures for, e.g. cation=Na,K.')
+@click.option('--count', default=1, type=int, help='Number of structures for every combination of the grid.')
+@click.option('--seed', default=None, type=int, help='Seed of the whole batch.')
+@click.option('--workers', default=1, type=int, help='Number of processes creating structures.')
+@click.option('--slab-cache', default=None, help='Folder in which the slabs are kept between runs.')
+def create_cations(yaml_file, grid, count, seed, workers, slab_cache):
+    """Creates independent starting structures for every combination of the inputs in the grid."""
+    folders = create_cation_batch(yaml_file, parse_grid_option(yaml_file, grid), count, seed, workers, slab_cache)
+    print(f'Created {len(folders)} structures.')
@@ -0,0 +1,205 @@
+"""Columnar store of the trajectories as memory-mappable numpy arrays."""
+import json
+import os
+import os.path as op
+import shutil
+from dataclasses import dataclass
+import numpy as np
+
+# Arrays stored for every frame and their dtype
+FRAME_ARRAYS = {
+    'timestep': np.int64,
+    'energy': np.float64,
+    'dipole': np.float64,
+    'cell': np.float64,
+    'positions': np.float64,
+}
+
+def get_frame_arrays(atoms, timestep):
+    """Get the per-frame arrays of an atoms object; missing results are nan."""
+    results = atoms.calc.results if atoms.calc is not None else {}
+    energy = results.get('energy')
+    dipole = results.get('dipole')
+    return {
+        'timestep': np.array(timestep, dtype=np.int64),
+        'energy': np.array(np.nan if energy is None else energy, dtype=np.float64),
+        'dipole': np.full(3, np.nan) if dipole is None else np.asarray(dipole, dtype=np.float64),
+        'cell': np.asarray(atoms.cell, dtype=np.float64),
+        'positions': np.asarray(atoms.positions, dtype=np.float64),
+    }
+
+def is_run_folder(folder):
+    """Check if a folder holds the metadata and the arrays of a run of the array store."""
+    return op.exists(op.join(folder, 'metadata.json')) and op.exists(op.join(folder, 'timestep.npy'))
+
+def finalize_npy(filename, part_filename, dtype, frame_shape, nframes, append):
+    """Write the raw frames of part_filename as an npy file, after the frames already in it."""
+    old_nframes = 0
+    old_offset = None
+    if append and op.exists(filename):
+        with open(filename, 'rb') as handle:
+            if np.lib.format.read_magic(handle) == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(handle)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(handle)
+            old_nframes = shape[0]
+            old_offset = handle.tell()
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+              'fortran_order': False,
+              'shape': (old_nframes + nframes,) + tuple(frame_shape)}
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as output:
+        np.lib.format.write_array_header_1_0(output, header)
+        if old_offset is not None:
+            with open(filename, 'rb') as handle:
+                handle.seek(old_offset)
+                shutil.copyfileobj(handle, output)
+        with open(part_filename, 'rb') as handle:
+            shutil.copyfileobj(handle, output)
+    os.replace(tmp_filename, filename)
+    os.remove(part_filename)
+
+class ArrayRunWriter:
+    """Write the frames of one state and run number to the array store.
+
+    The frames are appended to raw files while they are parsed and converted
+    into npy files when the writer is closed, so that the frames never have to be
+    held in memory at the same time.
+    """
+
+    def __init__(self, folder, state, run_number, append=False):
+        self.folder = folder
+        self.append = append
+        self.nframes = 0
+        self.frame_shapes = {}
+        os.makedirs(folder, exist_ok=True)
+        with open(op.join(folder, 'metadata.json'), 'w') as handle:
+            json.dump({'state': state, 'run_number': run_number}, handle)
+        self.handles = {name: open(op.join(folder, name + '.npy.part'), 'wb') for name in FRAME_ARRAYS}
+
+    def write(self, atoms, timestep):
+        """Append a single frame."""
+        if self.nframes == 0 and not (self.append and op.exists(op.join(self.folder, 'numbers.npy'))):
+            np.save(op.join(self.folder, 'numbers.npy'), atoms.numbers)
+        for name, array in get_frame_arrays(atoms, timestep).items():
+            self.frame_shapes[name] = array.shape
+            self.handles[name].write(np.ascontiguousarray(array, dtype=FRAME_ARRAYS[name]).tobytes())
+        self.nframes += 1
+
+    def close(self):
+        """Convert the frames written into npy files."""
+        for name, handle in self.handles.items():
+            handle.close()
+            filename = op.join(self.folder, name + '.npy')
+            part_filename = filename + '.part'
+            if self.nframes == 0:
+                os.remove(part_filename)
+                continue
+            finalize_npy(filename, part_filename, FRAME_ARRAYS[name], self.frame_shapes[name],
+                         self.nframes, self.append)
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        """Discard the frames written, keeping the arrays that were already stored."""
+        for name, handle in self.handles.items():
+            handle.close()
+            os.remove(op.join(self.folder, name + '.npy.part'))
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+@dataclass
+class ArrayStore:
+    """Columnar store of the trajectories next to the ASE database.
+
+    Every state and run number has a folder with the arrays positions
+    (nframes, natoms, 3), cell (nframes, 3, 3), energy (nframes,), dipole
+    (nframes, 3) and timestep (nframes,) as npy files, which can be memory-mapped
+    instead of unpickling the rows of the database.
+    Inputs
+    ------
+    path: str
+        The path to the folder of the store.
+    """
+    path: str
+
+    def get_folder(self, state, run_number):
+        """Get the folder of the arrays of a state and run number."""
+        return op.join(self.path, str(state), f'run_{run_number}')
+
+    def open_run(self, state, run_number, start=0):
+        """Writer for the frames of a run, appending to the stored frames if start is not 0."""
+        return ArrayRunWriter(self.get_folder(state, run_number), state, run_number, append=start > 0)
+
+    def load(self, mmap_mode='r'):
+        """Return a dict of the arrays of every (state, run_number), memory-mapped by default."""
+        trajectories = {}
+        for state in sorted(os.listdir(self.path)):
+            state_folder = op.join(self.path, state)
+            if not op.isdir(state_folder):
+                continue
+            for run in sorted(os.listdir(state_folder)):
+                folder = op.join(state_folder, run)
+                if not is_run_folder(folder):
+                    continue
+                with open(op.join(folder, 'metadata.json')) as handle:
+                    metadata = json.load(handle)
+                arrays = {name: np.load(op.join(folder, name + '.npy'), mmap_mode=mmap_mode)
+                          for name in list(FRAME_ARRAYS) + ['numbers']}
+                trajectories[(metadata['state'], metadata['run_number'])] = arrays
+        return trajectories
+
+def is_array_store(path):
+    """Check if the path is a folder written with --array-store, i.e. with a state/run_<number> folder of arrays."""
+    if not op.isdir(path):
+        return False
+    for state in os.listdir(path):
+        state_folder = op.join(path, state)
+        if not op.isdir(state_folder):
+            continue
+        for run in os.listdir(state_folder):
+            if run.startswith('run_') and is_run_folder(op.join(state_folder, run)):
+                return True
+    return False
+
+def iter_array_store(path, quantities, state=None, run_numbers=None, timesteps=None):
+    """Yield the quantities, run_number, timestep and state of the frames of every run as column blocks.
+
+    The quantities are an array with a column for each of energy and the
+    components dipole_x, dipole_y, dipole_z, and run_number and timestep arrays
+    with a value per frame; a quantity that a frame does not have is nan, and the
+    frames without any of the quantities are left out. The frames can be
+    restricted to a state and to inclusive (min, max) ranges of run numbers and
+    timesteps.
+    """
+    for (run_state, run_number), arrays in ArrayStore(path).load().items():
+        if state is not None and run_state != state:
+            continue
+        if not in_range(run_number, run_numbers):
+            continue
+        values = np.stack([arrays['energy'] if quantity == 'energy'
+                           else arrays['dipole'][:, 'xyz'.index(quantity[-1])]
+                           for quantity in quantities], axis=1)
+        timestep = arrays['timestep']
+        # Skip the frames where all the quantities are nan
+        mask = ~np.isnan(values).all(axis=1)
+        if timesteps is not None:
+            if timesteps[0] is not None:
+                mask &= timestep >= timesteps[0]
+            if timesteps[1] is not None:
+                mask &= timestep <= timesteps[1]
+        if not mask.any():
+            continue
+        yield values[mask], np.full(np.count_nonzero(mask), run_number), timestep[mask], run_state
+
+def in_range(value, bounds):
+    """Check if the value lies in the inclusive bounds (min, max); None is unbounded."""
+    if bounds is None:
+        return True
+    lower, upper = bounds
+    return (lower is None or value >= lower) and (upper is None or value <= upper)
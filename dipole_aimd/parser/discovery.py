@@ -0,0 +1,183 @@
+"""Find the trajectories of a campaign with a single walk of the directory tree."""
+import fnmatch
+import glob
+import json
+import os
+import os.path as op
+import re
+import time
+from dataclasses import dataclass
+
+# Listings of directories modified this close to when they were listed are not
+# trusted, since a change within the resolution of the mtime would go unnoticed
+RACY_INTERVAL_NS = 2 * 10**9
+
+def compile_segment(segment):
+    """Compile a segment of a glob pattern; ** is returned as is."""
+    if segment == '**':
+        return segment
+    # As for glob, names starting with a dot are only matched explicitly
+    return re.compile(fnmatch.translate(segment)), segment.startswith('.')
+
+def match_segment(compiled, name):
+    """Check if a file or directory name matches a compiled segment."""
+    regex, hidden = compiled
+    if name.startswith('.') and not hidden:
+        return False
+    return regex.match(name) is not None
+
+@dataclass
+class GlobPattern:
+    """Glob pattern matched one directory at a time, with the rules of glob.glob(pattern, recursive=True).
+
+    The segments of the pattern matched by the directories above an entry are
+    kept as a set of states, so that a directory that cannot lead to a match is
+    not descended into and no path is matched from the top again.
+    Inputs
+    ------
+    pattern: str
+        The glob pattern relative to the top of the tree, with / between segments.
+    """
+    pattern: str
+
+    def __post_init__(self):
+        segments = self.pattern.split('/')
+        if segments[-1] == '**':
+            raise ValueError(f'{self.pattern} ends with **, the last segment has to match the files.')
+        self.segments = [compile_segment(segment) for segment in segments]
+        self.last = len(segments) - 1
+        # The last segment without wildcards is looked up rather than matched
+        self.literal = segments[-1] if not glob.has_magic(segments[-1]) else None
+        # The states reached from every state by ** matching no directory
+        self.closures = []
+        for index in range(len(segments)):
+            closure = {index}
+            while index < self.last and segments[index] == '**':
+                index += 1
+                closure.add(index)
+            self.closures.append(frozenset(closure))
+
+    def start(self):
+        """States at the top of the tree."""
+        return self.closures[0]
+
+    def descend(self, states, name):
+        """States in the subdirectory name of a directory with the given states."""
+        new_states = set()
+        for index in states:
+            segment = self.segments[index]
+            if segment == '**':
+                # ** does not match hidden directories
+                if not name.startswith('.'):
+                    new_states.update(self.closures[index])
+            elif index < self.last and match_segment(segment, name):
+                new_states.update(self.closures[index + 1])
+        return frozenset(new_states)
+
+    def match(self, states, names):
+        """Return the entry names of a directory with the given states that match the pattern."""
+        if self.last not in states:
+            return []
+        if self.literal is not None:
+            return [self.literal] if self.literal in names else []
+        return [name for name in names if match_segment(self.segments[self.last], name)]
+
+@dataclass
+class DirectoryWalker:
+    """Walk a directory tree with os.scandir, optionally caching the listings between runs.
+
+    A cached listing is used when the modification time of its directory has not
+    changed, so that a run only costs a stat for every unchanged directory.
+    Inputs
+    ------
+    root: str
+        The top of the tree; paths are returned relative to it.
+    cache_file: str
+        The path to the json file with the cached listings, no cache if None.
+    """
+    root: str = '.'
+    cache_file: str = None
+
+    def __post_init__(self):
+        self.cache = {}
+        if self.cache_file is not None and op.exists(self.cache_file):
+            with open(self.cache_file, 'r') as handle:
+                self.cache = json.load(handle)
+        self.listed = {}
+        self.changed = False
+
+    def listdir(self, path):
+        """Return the sorted names of the subdirectories and the other entries of a directory."""
+        full_path = op.join(self.root, path) if path else self.root
+        if self.cache_file is not None:
+            mtime = os.stat(full_path).st_mtime_ns
+            cached = self.cache.get(path)
+            if cached is not None and cached['mtime'] == mtime and mtime < cached['listed'] - RACY_INTERVAL_NS:
+                self.listed[path] = cached
+                return cached['dirs'], cached['files']
+            listed = time.time_ns()
+            self.changed = True
+        directories = []
+        files = []
+        with os.scandir(full_path) as entries:
+            for entry in entries:
+                # Symbolic links to directories are followed, as by glob
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                (directories if is_dir else files).append(entry.name)
+        directories.sort()
+        files.sort()
+        if self.cache_file is not None:
+            self.listed[path] = {'mtime': mtime, 'listed': listed, 'dirs': directories, 'files': files}
+        return directories, files
+
+    def save(self):
+        """Write the listings of the directories walked so far to the cache file, if any was listed again."""
+        if self.cache_file is None or not (self.changed or self.listed.keys() != self.cache.keys()):
+            return
+        tmp_filename = self.cache_file + '.tmp'
+        with open(tmp_filename, 'w') as handle:
+            json.dump(self.listed, handle)
+        os.replace(tmp_filename, self.cache_file)
+
+    def find(self, patterns, exclude=None):
+        """Return the sorted paths that match any of the glob patterns and do not contain exclude.
+
+        The tree is walked once for all the patterns; directories that no pattern
+        can match below, or whose path already contains exclude, are not listed.
+        """
+        patterns = [GlobPattern(pattern) for pattern in patterns]
+        found = set()
+        stack = [('', [pattern.start() for pattern in patterns])]
+        while stack:
+            path, states = stack.pop()
+            try:
+                directories, files = self.listdir(path)
+            except OSError:
+                # As glob, skip directories that cannot be read
+                continue
+            prefix = path + os.sep if path else ''
+            names = directories + files
+            for pattern, state in zip(patterns, states):
+                for name in pattern.match(state, names):
+                    entry_path = prefix + name
+                    if exclude is None or exclude not in entry_path:
+                        found.add(entry_path)
+            for name in directories:
+                dir_path = prefix + name
+                # Every path below a directory containing exclude contains it too
+                if exclude is not None and exclude in dir_path + os.sep:
+                    continue
+                new_states = [pattern.descend(state, name) for pattern, state in zip(patterns, states)]
+                if any(new_states):
+                    stack.append((dir_path, new_states))
+        self.save()
+        return sorted(found)
+
+def find_files(patterns, exclude=None, root='.', cache_file=None):
+    """Return the paths below root matching any of the glob patterns, walking the tree once."""
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return DirectoryWalker(root, cache_file).find(patterns, exclude)
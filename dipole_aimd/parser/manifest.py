@@ -0,0 +1,105 @@
+"""Keep track of the trajectories that have already been stored in a database."""
+import hashlib
+import json
+import os
+import os.path as op
+from dataclasses import dataclass
+
+def hash_file(filename, size=None, chunk_size=1 << 20):
+    """Return the sha256 of the first size bytes of a file.
+
+    The hash object is returned together with the digest, so that the hash of a
+    longer file can be computed without reading the first size bytes again.
+    """
+    sha = hashlib.sha256()
+    remaining = size
+    with open(filename, 'rb') as handle:
+        while remaining is None or remaining > 0:
+            length = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = handle.read(length)
+            if not chunk:
+                break
+            sha.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return sha.hexdigest(), sha
+
+def continue_hash(filename, sha, offset, chunk_size=1 << 20):
+    """Continue the hash sha of the first offset bytes of a file until its end."""
+    with open(filename, 'rb') as handle:
+        handle.seek(offset)
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+@dataclass
+class IngestManifest:
+    """Manifest of the files stored in an ASE database.
+
+    Each file is recorded with its size, modification time, sha256 hash, the number
+    of frames stored and the range of database ids of those frames. The manifest
+    is a json file next to the database, so that re-running the parser only stores
+    what is new since the last run.
+    Inputs
+    ------
+    filename: str
+        The path to the json manifest.
+    dbname: str
+        The path to the ASE database the manifest belongs to.
+    """
+    filename: str
+    dbname: str
+
+    def __post_init__(self):
+        self.entries = {}
+        # A manifest without its database would skip everything
+        if op.exists(self.filename) and op.exists(self.dbname):
+            with open(self.filename, 'r') as handle:
+                self.entries = json.load(handle)
+
+    def check(self, path):
+        """Compare the file with the manifest.
+
+        Returns the fingerprint of the file, the number of frames already stored
+        (None if the file is unchanged and nothing has to be done), and the ids of
+        the rows that have to be removed because the file has been rewritten.
+        """
+        stat = os.stat(path)
+        fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        entry = self.entries.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            fingerprint['sha256'] = entry['sha256']
+            return fingerprint, None, []
+        if entry is not None and stat.st_size >= entry['size']:
+            digest, sha = hash_file(path, entry['size'])
+            if digest == entry['sha256']:
+                # The file has only been appended to, e.g. by a running job
+                fingerprint['sha256'] = continue_hash(path, sha, entry['size'])
+                if stat.st_size == entry['size']:
+                    self.update(path, fingerprint, 0, [])
+                    return fingerprint, None, []
+                return fingerprint, entry['nframes'], []
+        fingerprint['sha256'], _ = hash_file(path)
+        stale_ids = []
+        if entry is not None:
+            for first, last in entry['ids']:
+                stale_ids.extend(range(first, last + 1))
+            # The frames are stored again from the start
+            del self.entries[path]
+        return fingerprint, 0, stale_ids
+
+    def update(self, path, fingerprint, nframes, ids):
+        """Record that nframes more frames of the file were stored with the ids."""
+        entry = self.entries.setdefault(path, {'nframes': 0, 'ids': []})
+        entry.update(fingerprint)
+        entry['nframes'] += nframes
+        if ids:
+            entry['ids'].append([ids[0], ids[-1]])
+        self.save()
+
+    def save(self):
+        """Write the manifest atomically so that an interrupted run does not corrupt it."""
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as handle:
+            json.dump(self.entries, handle, indent=1)
+        os.replace(tmp_filename, self.filename)
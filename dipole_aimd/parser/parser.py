@@ -1,106 +1,299 @@
 """Get all the folders with details.yaml and store the atoms object in the database."""
 from pprint import pprint
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from ase.db import connect
+import cProfile
+import os.path as op
+import time
 import click
-import glob
-from dipole_aimd.parser.parser_dipole import StoreAtomsinASEdb
+from dipole_aimd.parser.parser_dipole import StoreAtomsinASEdb, create_indices
+from dipole_aimd.parser.parser_scalars import StoreScalarsinSQLite
+from dipole_aimd.parser.parser_compact import StoreCompactinSQLite, DTYPES
+from dipole_aimd.parser.manifest import IngestManifest
+from dipole_aimd.parser.report import IngestReport, StageTimer, get_trajectory_size
+from dipole_aimd.parser.discovery import find_files
+from dipole_aimd.parser.readers import COMPRESSIONS
 
-@click.command()
-@click.option('--dbname', default='test.db')
-@click.option('--default', default=None)
-@click.option('--consider', default=None)
-@click.option('--exclude', default=None)
-@click.option('--exact', default=None)
-def store_to_database(dbname, default, consider, exclude, exact):
-    """Finds all the folders of arbitrary depth which contain details.yaml."""
+# Name of the output file relative to the discovered path for each default
+VASPOUT = {
+    None: 'vasprun.xml',
+    'recursive': 'vasprun.xml',
+    'all_in_one': '',
+    'run_folders': '',
+}
+
+def with_compressions(pattern):
+    """The pattern and the patterns of its compressed files."""
+    if pattern.endswith('*'):
+        # Compressed files already match
+        return [pattern]
+    return [pattern] + [pattern + extension for extension in COMPRESSIONS]
+
+def get_folder(path):
+    """The folder of a path, ending with a separator or empty."""
+    return path[:len(path) - len(op.basename(path))]
+
+def find_foldernames(default, consider=None, exclude=None, exact=None, cache_file=None):
+    """Find the folders or files of the trajectories laid out according to the default.
+
+    The tree is walked once, and directories whose path contains exclude are not
+    descended into; see find_files.
+    """
     if default is None:
         # If no defaults are given, use the values from the details.yaml file
-        all_paths = glob.glob('**/details.yaml', recursive=True)
-        for paths in all_paths:
-            foldername = paths.replace('details.yaml', '')
-            method = StoreAtomsinASEdb(dbname=dbname, foldername=foldername)
-            method.get_specifics()
-            method.validate_inputs()
-            method.store_attributes()
+        all_paths = find_files('**/details.yaml', cache_file=cache_file)
+        return [paths.replace('details.yaml', '') for paths in all_paths]
     elif default == 'recursive':
         # This default assumes that the user has a set of recursive folders
-        # where restarts are stored in folders are increases in depth. 
+        # where restarts are stored in folders are increases in depth.
         # Find all the directories that have a vasprun.xml file.
         print('Recursive path chosen.')
         if consider is not None:
-            all_paths = glob.glob('*' + consider + '*/**/vasprun.xml', recursive=True)
+            pattern = '*' + consider + '*/**/vasprun.xml'
         elif exact is not None:
-            all_paths = glob.glob(exact + '*/**/vasprun.xml', recursive=True)
+            pattern = exact + '*/**/vasprun.xml'
         else:
-            all_paths = glob.glob('**/vasprun.xml', recursive=True)
-        for paths in all_paths:
-            if exclude not in paths:
-                print(paths)
-                foldername = paths.replace('vasprun.xml', '')
-                try:
-                    method = StoreAtomsinASEdb(dbname=dbname, foldername=foldername)
-                    method.get_specifics_for_recursive()
-                    method.store_attributes()
-                except:
-                    error_file = dbname.replace('.db', '_error.txt')
-                    print('Could not store {}'.format(foldername), file=open(error_file, 'a'))
-                    continue
-                # If it is successful, store the folder name parsed
-                completed_file = dbname.replace('.db', '_completed.txt')
-                print(foldername, file=open(completed_file, 'a'))
+            pattern = '**/vasprun.xml'
+        all_paths = find_files(with_compressions(pattern), exclude=exclude, cache_file=cache_file)
+        # A folder can have both a vasprun.xml file and a compressed one
+        return list(dict.fromkeys(get_folder(paths) for paths in all_paths))
     elif default == 'all_in_one':
         # This default assumes that the user has all the OUTCARs in one folder
         # and the OUTCAR order is decided by the name of the OUTCAR file. The idea is then
         # to collect all of the files with the name OUTCAR
         print('All in one path chosen.')
         if consider is not None:
-            all_paths = glob.glob('*' + consider + '**/OUTCAR*', recursive=True)
+            pattern = '*' + consider + '**/OUTCAR*'
         elif exact is not None:
-            all_paths = glob.glob('*/' + exact + '**/OUTCAR*', recursive=True)
+            pattern = '*/' + exact + '**/OUTCAR*'
         else:
-            all_paths = glob.glob('**/OUTCAR*', recursive=True)
-
-        for paths in all_paths:
-            if exclude is not None:
-                if exclude in paths:
-                    continue
-            foldername = paths
-            try:
-                method = StoreAtomsinASEdb(dbname=dbname, foldername=foldername)
-                method.get_specifics_for_all_in_one()
-                method.store_attributes('')
-            except:
-                error_file = dbname.replace('.db', '_error.txt')
-                print('Could not store {}'.format(foldername), file=open(error_file, 'a'))
-                continue
-            # If it is successful, store the folder name parsed
-            completed_file = dbname.replace('.db', '_completed.txt')
-            print(foldername, file=open(completed_file, 'a'))
+            pattern = '**/OUTCAR*'
+        return find_files(pattern, exclude=exclude, cache_file=cache_file)
     elif default == 'run_folders':
         # This default assumes that all the outcar files are in folders
         # called run_XYZ where XYZ is the run number.
         print('Run folders path chosen.')
         if consider is not None:
-            all_paths = glob.glob('*' + consider + '*/run_**/vasprun.xml', recursive=True)
+            pattern = '*' + consider + '*/run_**/vasprun.xml'
         elif exact is not None:
-            all_paths = glob.glob('*/' + exact + '*/run_**/vasprun.xml*', recursive=True)
+            pattern = '*/' + exact + '*/run_**/vasprun.xml*'
         else:
-            all_paths = glob.glob('**/run_**/OUTCAR*', recursive=True)
-        
-        for paths in all_paths:
-            if exclude is not None:
-                if exclude in paths:
-                    continue
-            foldername = paths
-
-            try:
-                method = StoreAtomsinASEdb(dbname=dbname, foldername=foldername)
-                method.get_specifics_for_run_folders()
-                method.store_attributes('')
-            except:
-                error_file = dbname.replace('.db', '_error.txt')
-                print('Could not store {}'.format(foldername), file=open(error_file, 'a'))
+            pattern = '**/run_**/OUTCAR*'
+        return find_files(with_compressions(pattern), exclude=exclude, cache_file=cache_file)
+    raise ValueError(f'Unknown default {default}')
+
+def get_method(dbname, foldername, default, scalars_only=False, compact=None, **store_options):
+    """Create the storage class and get the specifics based on the default.
+
+    compact is the dtype of the positions and forces of a compact database, None
+    for an ASE database.
+    """
+    if scalars_only:
+        method = StoreScalarsinSQLite(dbname=dbname, foldername=foldername, **store_options)
+    elif compact is not None:
+        method = StoreCompactinSQLite(dbname=dbname, foldername=foldername, dtype=compact, **store_options)
+    else:
+        method = StoreAtomsinASEdb(dbname=dbname, foldername=foldername, **store_options)
+    if default is None:
+        method.get_specifics()
+        method.validate_inputs()
+    elif default == 'recursive':
+        method.get_specifics_for_recursive()
+    elif default == 'all_in_one':
+        method.get_specifics_for_all_in_one()
+    elif default == 'run_folders':
+        method.get_specifics_for_run_folders()
+    else:
+        raise ValueError(f'Unknown default {default}')
+    return method
+
+def parse_trajectory(method, vaspout, start):
+    """Parse a single trajectory, run in a worker process; return the frames and the time it took."""
+    start_time = time.perf_counter()
+    # Frames cannot be streamed between processes, so send the whole trajectory
+    frames = list(method.read_trajectory(vaspout, start))
+    return frames, time.perf_counter() - start_time
+
+def prepare_trajectory(dbname, foldername, default, manifest, store_options):
+    """Create the storage class and find the first frame that has to be stored.
+
+    Without a manifest every frame is stored. With a manifest, the first frame is
+    None if the trajectory is unchanged, and the rows of a trajectory that has been
+    rewritten are removed from the database.
+    """
+    method = get_method(dbname, foldername, default, **store_options)
+    if manifest is None:
+        return method, 0, None
+    filename = method.get_trajectory_filename(VASPOUT[default])
+    fingerprint, start, stale_ids = manifest.check(filename)
+    if stale_ids:
+        print(f'{filename} has changed, removing {len(stale_ids)} stored frames')
+        method.delete_rows(stale_ids)
+    return method, start, fingerprint
+
+def record_stored(dbname, foldername, method, default, manifest, fingerprint, ids):
+    """Store the name of the folder and update the manifest with the frames written."""
+    if manifest is not None:
+        filename = method.get_trajectory_filename(VASPOUT[default])
+        manifest.update(filename, fingerprint, len(ids), ids)
+    record_completed(dbname, foldername)
+
+def record_error(dbname, foldername, error):
+    """Store the name of the folder that could not be parsed and the reason."""
+    error_file = dbname.replace('.db', '_error.txt')
+    print('Could not store {}: {}: {}'.format(foldername, type(error).__name__, error), file=open(error_file, 'a'))
+
+def record_completed(dbname, foldername):
+    """Store the name of the folder that was successfully parsed."""
+    completed_file = dbname.replace('.db', '_completed.txt')
+    print(foldername, file=open(completed_file, 'a'))
+
+def ingest_serial(dbname, foldernames, default, manifest=None, report=None, **store_options):
+    """Parse and store the trajectories one after the other."""
+    report = report or IngestReport()
+    vaspout = VASPOUT[default]
+    for foldername in foldernames:
+        print(foldername)
+        timer = StageTimer()
+        size = None
+        try:
+            with timer.stage('prepare'):
+                method, start, fingerprint = prepare_trajectory(dbname, foldername, default, manifest, store_options)
+            if start is None:
+                print(f'{foldername} is unchanged, skipping.')
+                report.trajectory(foldername, 'skipped', timer)
                 continue
+            size = get_trajectory_size(method, vaspout)
+            print(f"Storing {method.foldername}")
+            with timer.stage('parse'):
+                atoms_traj = method.read_trajectory(vaspout, start)
+            with timer.stage('write'):
+                # Frames parsed while they are written are counted as parsing
+                ids = method.write_trajectory(timer.iterate(atoms_traj), start)
+        except Exception as error:
+            report.trajectory(foldername, 'failed', timer, size=size, error=error)
+            if default is None:
+                # The details.yaml files are written by hand, so fail loudly
+                raise
+            record_error(dbname, foldername, error)
+            continue
+        with timer.stage('write'):
+            record_stored(dbname, foldername, method, default, manifest, fingerprint, ids)
+        report.trajectory(foldername, 'stored', timer, len(ids), size)
 
+def ingest_parallel(dbname, foldernames, default, workers, manifest=None, report=None, **store_options):
+    """Parse the trajectories in a process pool and write them from this process.
 
+    Only the parent process connects to the database, so that there is a single
+    writer and no contention for the SQLite lock. At most two trajectories per
+    worker are kept in flight to bound the memory used by parsed frames.
+    """
+    report = report or IngestReport()
+    foldernames = iter(foldernames)
+    vaspout = VASPOUT[default]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        def submit():
+            for foldername in foldernames:
+                timer = StageTimer()
+                try:
+                    with timer.stage('prepare'):
+                        method, start, fingerprint = prepare_trajectory(dbname, foldername, default, manifest, store_options)
+                except Exception as error:
+                    report.trajectory(foldername, 'failed', timer, error=error)
+                    if default is None:
+                        raise
+                    record_error(dbname, foldername, error)
+                    continue
+                if start is None:
+                    print(f'{foldername} is unchanged, skipping.')
+                    report.trajectory(foldername, 'skipped', timer)
+                    continue
+                future = executor.submit(parse_trajectory, method, vaspout, start)
+                pending[future] = (foldername, method, start, fingerprint, timer, get_trajectory_size(method, vaspout))
+                if len(pending) >= 2 * workers:
+                    break
+        submit()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                foldername, method, start, fingerprint, timer, size = pending.pop(future)
+                print(foldername)
+                try:
+                    atoms_traj, timer.times['parse'] = future.result()
+                    print(f"Storing {method.foldername}")
+                    with timer.stage('write'):
+                        ids = method.write_trajectory(atoms_traj, start)
+                except Exception as error:
+                    report.trajectory(foldername, 'failed', timer, size=size, error=error)
+                    if default is None:
+                        raise
+                    record_error(dbname, foldername, error)
+                    continue
+                with timer.stage('write'):
+                    record_stored(dbname, foldername, method, default, manifest, fingerprint, ids)
+                report.trajectory(foldername, 'stored', timer, len(ids), size)
+            submit()
+
+@click.command()
+@click.option('--dbname', default='test.db')
+@click.option('--default', default=None)
+@click.option('--consider', default=None)
+@click.option('--exclude', default=None)
+@click.option('--exact', default=None)
+@click.option('--workers', default=1, type=int, help='Number of processes parsing trajectories.')
+@click.option('--batch-size', default=1000, type=int, help='Number of frames committed per transaction.')
+@click.option('--stream', is_flag=True, help='Write each frame as soon as it is parsed; not with --workers.')
+@click.option('--incremental', is_flag=True, help='Only store trajectories that are new or have grown since the last run.')
+@click.option('--scalars-only', is_flag=True, help='Only store the energy and the dipole of every frame.')
+@click.option('--array-store', default=None, help='Folder of a columnar store of numpy arrays written next to the database.')
+@click.option('--report', default=None, help='Json-lines report of the timings of every trajectory, <dbname>_report.jsonl by default.')
+@click.option('--profile', default=None, help='File the cProfile statistics of the ingest are written to.')
+@click.option('--discovery-cache', default=None, help='Json file caching the directory listings between runs.')
+@click.option('--compact', is_flag=True, help='Store the topology of every run once and the frames as packed arrays.')
+@click.option('--compact-dtype', default='float64', type=click.Choice(DTYPES), help='Precision of the positions and forces of --compact.')
+def store_to_database(dbname, default, consider, exclude, exact, workers, batch_size, stream, incremental, scalars_only, array_store,
+                      report, profile, discovery_cache, compact, compact_dtype):
+    """Finds all the folders of arbitrary depth which contain details.yaml."""
+    if scalars_only and array_store is not None:
+        raise click.UsageError('--array-store needs the atoms objects and cannot be used with --scalars-only.')
+    if scalars_only and compact:
+        raise click.UsageError('--compact stores the atoms objects and cannot be used with --scalars-only.')
+    if stream and workers > 1:
+        raise click.UsageError('The workers send whole trajectories to the writer, --stream cannot be used with --workers.')
+    # The storage classes get the dtype of a compact database, None otherwise
+    compact = compact_dtype if compact else None
+    report = IngestReport(report or dbname.replace('.db', '_report.jsonl'))
+    report.start(dbname=dbname, default=default, consider=consider, exclude=exclude, exact=exact, workers=workers,
+                 batch_size=batch_size, stream=stream, incremental=incremental, scalars_only=scalars_only,
+                 array_store=array_store, compact=compact)
+    discover_start = time.perf_counter()
+    foldernames = find_foldernames(default, consider, exclude, exact, discovery_cache)
+    report.discovered(foldernames, time.perf_counter() - discover_start)
+
+    manifest = None
+    if incremental:
+        manifest = IngestManifest(filename=dbname.replace('.db', '_manifest.json'), dbname=dbname)
+
+    # Only this process is profiled, not the workers parsing the trajectories
+    profiler = cProfile.Profile() if profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if workers > 1:
+            ingest_parallel(dbname, foldernames, default, workers, manifest=manifest, report=report,
+                            scalars_only=scalars_only, compact=compact,
+                            batch_size=batch_size, stream=stream, array_store=array_store)
+        else:
+            ingest_serial(dbname, foldernames, default, manifest=manifest, report=report,
+                          scalars_only=scalars_only, compact=compact,
+                          batch_size=batch_size, stream=stream, array_store=array_store)
 
+        if not scalars_only and compact is None:
+            # Allow the analysis to select rows by state, run_number and timestep
+            create_indices(dbname)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        report.summary(profile=profile)
@@ -0,0 +1,274 @@
+"""Class to store the frames into a compact SQLite database, with the topology of every run stored once."""
+import json
+import os.path as op
+import sqlite3
+from dataclasses import dataclass
+import numpy as np
+from ase import Atoms
+from ase.calculators.singlepoint import SinglePointCalculator
+from ase.constraints import dict2constraint
+from dipole_aimd.parser.parser_dipole import StoreAtomsinASEdb, insert_in_batches, add_range, get_conditions
+
+COMPACT_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    state TEXT,
+    run_number INTEGER,
+    dtype TEXT,
+    numbers BLOB,
+    cell BLOB,
+    pbc INTEGER,
+    constraints TEXT,
+    UNIQUE (state, run_number))""",
+    """CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER,
+    timestep INTEGER,
+    energy REAL,
+    free_energy REAL,
+    magmom REAL,
+    dipole_x REAL,
+    dipole_y REAL,
+    dipole_z REAL,
+    positions BLOB,
+    forces BLOB,
+    stress BLOB,
+    magmoms BLOB,
+    cell BLOB)""",
+    'CREATE INDEX IF NOT EXISTS frames_index ON frames(run_id, timestep)',
+]
+
+INSERT_FRAMES = f'INSERT INTO frames VALUES ({", ".join("?" * 14)})'
+
+# Per-atom or per-frame results stored as packed arrays in the dtype of the run
+RESULT_ARRAYS = ('forces', 'stress', 'magmoms')
+
+# Precisions of the positions and results
+DTYPES = ('float64', 'float32')
+
+def is_compact_database(filename):
+    """Check if the file is a database written with --compact."""
+    if not op.isfile(filename):
+        return False
+    connection = sqlite3.connect(filename)
+    try:
+        cursor = connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ('runs', 'frames')")
+        return cursor.fetchone()[0] == 2
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        connection.close()
+
+def pack(array, dtype):
+    """The array as a blob of dtype, None if there is no array."""
+    if array is None:
+        return None
+    return np.ascontiguousarray(array, dtype=dtype).tobytes()
+
+def unpack(blob, dtype, shape=(-1,)):
+    """The array of a blob, as float64; None if there is no blob."""
+    if blob is None:
+        return None
+    return np.frombuffer(blob, dtype=dtype).astype(np.float64).reshape(shape)
+
+def to_float(value):
+    """The value as a float for SQLite, None if there is no value."""
+    return None if value is None else float(value)
+
+def to_json(value):
+    """Convert the numpy arrays and numbers of a constraint for json."""
+    return np.asarray(value).tolist()
+
+def encode_pbc(pbc):
+    """The periodic directions as a bitmask."""
+    return int(sum(1 << index for index, periodic in enumerate(pbc) if periodic))
+
+def decode_pbc(mask):
+    """The periodic directions of a bitmask."""
+    return [bool(mask & (1 << index)) for index in range(3)]
+
+@dataclass
+class StoreCompactinSQLite(StoreAtomsinASEdb):
+    """Store the frames with the topology of every run stored once.
+
+    The atomic numbers, cell, periodicity and constraints of a state and run
+    number are stored in a single row of the runs table. Every frame is a row of
+    the frames table with its timestep, the energies and the dipole as numbers,
+    and the positions and forces as packed arrays of dtype. The cell of a frame is
+    only stored if it differs from that of its run. CompactDatabase rebuilds the
+    atoms objects.
+    """
+    dtype: str = 'float64'
+
+    def __post_init__(self):
+        if self.dtype not in DTYPES:
+            raise ValueError(f'Unknown dtype {self.dtype}, choose from {DTYPES}.')
+
+    def connect(self):
+        """Connect to the database and create the tables if needed."""
+        connection = sqlite3.connect(self.dbname, timeout=20)
+        cursor = connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ('systems', 'scalars')")
+        if cursor.fetchone()[0]:
+            connection.close()
+            raise ValueError(f'{self.dbname} is not a compact database, use a different dbname for --compact.')
+        for statement in COMPACT_SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    def get_run(self, connection, atoms):
+        """Return the id and the cell of the run, which is stored from atoms if it is new."""
+        row = connection.execute('SELECT id, dtype, numbers, cell FROM runs WHERE state=? AND run_number=?',
+                                 (self.state, self.run_number)).fetchone()
+        if row is not None:
+            run_id, dtype, numbers, cell = row
+            if dtype != self.dtype or not np.array_equal(np.frombuffer(numbers, dtype=np.int32), atoms.numbers):
+                raise ValueError(f'{self.state} run {self.run_number} is already stored with different atoms or dtype.')
+            return run_id, np.frombuffer(cell, dtype=np.float64).reshape(3, 3)
+        cell = np.asarray(atoms.cell, dtype=np.float64)
+        constraints = json.dumps([constraint.todict() for constraint in atoms.constraints], default=to_json)
+        cursor = connection.execute('INSERT INTO runs VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)',
+                                    (self.state, self.run_number, self.dtype, pack(atoms.numbers, np.int32),
+                                     pack(cell, np.float64), encode_pbc(atoms.pbc), constraints))
+        return cursor.lastrowid, cell
+
+    def get_row(self, atoms, run_id, run_cell, timestep):
+        """The values of the row of a frame."""
+        results = atoms.calc.results if atoms.calc is not None else {}
+        dipole = results.get('dipole')
+        dipole = (None, None, None) if dipole is None else tuple(float(value) for value in dipole)
+        cell = np.asarray(atoms.cell, dtype=np.float64)
+        return (run_id, timestep, to_float(results.get('energy')), to_float(results.get('free_energy')),
+                to_float(results.get('magmom')), *dipole,
+                pack(atoms.positions, self.dtype),
+                *(pack(results.get(name), self.dtype) for name in RESULT_ARRAYS),
+                None if np.array_equal(cell, run_cell) else pack(cell, np.float64))
+
+    def get_rows(self, connection, atoms_traj, start, first_id, arrays):
+        """Yield the rows of the frames table with ids from first_id, writing the frames to the array store."""
+        run_id = None
+        for row_id, (index, atoms) in enumerate(enumerate(atoms_traj, start), first_id):
+            if run_id is None:
+                run_id, run_cell = self.get_run(connection, atoms)
+            if arrays is not None:
+                arrays.write(atoms, index)
+            yield (row_id,) + self.get_row(atoms, run_id, run_cell, index)
+
+    def write_frames(self, atoms_traj, start=0):
+        """Write the frames of a trajectory, batch_size rows per transaction."""
+        connection = self.connect()
+        try:
+            first_id = connection.execute('SELECT COALESCE(MAX(id), 0) FROM frames').fetchone()[0] + 1
+            with self.open_array_store(start) as arrays:
+                nrows = insert_in_batches(connection, INSERT_FRAMES,
+                                          self.get_rows(connection, atoms_traj, start, first_id, arrays),
+                                          self.batch_size)
+        finally:
+            connection.close()
+        return list(range(first_id, first_id + nrows))
+
+    def delete_rows(self, ids):
+        """Remove frames that were previously stored from the database."""
+        connection = self.connect()
+        try:
+            connection.executemany('DELETE FROM frames WHERE id=?', [(row_id,) for row_id in ids])
+            connection.commit()
+        finally:
+            connection.close()
+
+@dataclass
+class CompactRow:
+    """A frame of a compact database, whose atoms object is only built when asked for."""
+    id: int
+    state: str
+    run_number: int
+    timestep: int
+    energy: float
+    free_energy: float
+    dipole: list
+    topology: dict
+    blobs: tuple
+
+    def toatoms(self):
+        """Build the atoms object with a single point calculator holding the results of the frame."""
+        topology = self.topology
+        dtype = topology['dtype']
+        magmom, positions, forces, stress, magmoms, cell = self.blobs
+        atoms = Atoms(topology['numbers'], positions=unpack(positions, dtype, (-1, 3)),
+                      cell=topology['cell'] if cell is None else unpack(cell, np.float64, (3, 3)),
+                      pbc=topology['pbc'])
+        if topology['constraints']:
+            atoms.set_constraint([dict2constraint(constraint) for constraint in topology['constraints']])
+        results = {'energy': self.energy, 'free_energy': self.free_energy, 'magmom': magmom,
+                   'dipole': None if self.dipole is None else np.array(self.dipole),
+                   'forces': unpack(forces, dtype, (-1, 3)), 'stress': unpack(stress, dtype),
+                   'magmoms': unpack(magmoms, dtype)}
+        results = {name: value for name, value in results.items() if value is not None}
+        if results:
+            atoms.calc = SinglePointCalculator(atoms, **results)
+        return atoms
+
+@dataclass
+class CompactDatabase:
+    """Read the frames of a database written with --compact.
+
+    The topology of every run is read once and shared by the rows of its frames.
+    Inputs
+    ------
+    filename: str
+        The path to the compact database.
+    """
+    filename: str
+
+    def __post_init__(self):
+        if not is_compact_database(self.filename):
+            raise ValueError(f'{self.filename} is not a compact database.')
+        self.topologies = {}
+
+    def get_topology(self, connection, run_id):
+        """The atomic numbers, cell, periodicity and constraints of a run."""
+        if run_id not in self.topologies:
+            dtype, numbers, cell, pbc, constraints = connection.execute(
+                'SELECT dtype, numbers, cell, pbc, constraints FROM runs WHERE id=?', (run_id,)).fetchone()
+            self.topologies[run_id] = {'dtype': dtype, 'numbers': np.frombuffer(numbers, dtype=np.int32),
+                                       'cell': unpack(cell, np.float64, (3, 3)), 'pbc': decode_pbc(pbc),
+                                       'constraints': json.loads(constraints)}
+        return self.topologies[run_id]
+
+    def select(self, state=None, run_numbers=None, timesteps=None, ids=None):
+        """Yield a CompactRow for every frame, in the order they were stored.
+
+        state selects a single state, and run_numbers, timesteps and ids are
+        inclusive (min, max) ranges, either of which can be None.
+        """
+        conditions, args = get_conditions('runs.state', 'runs.run_number', 'frames.timestep', state, run_numbers, timesteps)
+        add_range(conditions, args, 'frames.id', ids)
+        sql = f"""SELECT frames.id, runs.state, runs.run_number, frames.timestep, frames.energy, frames.free_energy,
+        frames.dipole_x, frames.dipole_y, frames.dipole_z, frames.run_id,
+        frames.magmom, frames.positions, frames.forces, frames.stress, frames.magmoms, frames.cell
+        FROM frames JOIN runs ON runs.id = frames.run_id
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY frames.id"""
+        connection = sqlite3.connect(self.filename)
+        try:
+            for row in connection.execute(sql, args):
+                dipole = None if row[6] is None else list(row[6:9])
+                yield CompactRow(row[0], row[1], row[2], row[3], row[4], row[5], dipole,
+                                 self.get_topology(connection, row[9]), row[10:])
+        finally:
+            connection.close()
+
+    def get_atoms(self, id):
+        """The atoms object of the frame with the id."""
+        for row in self.select(ids=(id, id)):
+            return row.toatoms()
+        raise KeyError(id)
+
+    def count(self):
+        """The number of frames."""
+        connection = sqlite3.connect(self.filename)
+        try:
+            return connection.execute('SELECT COUNT(*) FROM frames').fetchone()[0]
+        finally:
+            connection.close()
@@ -1,14 +1,181 @@
 """Class to store the atoms into an ASE database."""
+from contextlib import nullcontext
 from dataclasses import dataclass
+import numbers
+import os
 import os.path as op
+import sqlite3
+import time
+import uuid
+import numpy as np
 import yaml
 from ase import db
+from ase.calculators.calculator import all_properties
+from ase.data import atomic_numbers
+from ase.db.core import check, now
+from ase.db.row import AtomsRow
+from ase.db.sqlite import SQLite3Database, VERSION
 from ase.io import read, ParseError
+from dipole_aimd.parser.readers import iread_trajectory, get_compression, strip_compression, COMPRESSIONS
+from dipole_aimd.parser.array_store import ArrayStore
+
+# Indices on the key-value tables of an ASE database so that rows can be
+# selected by state, run_number and timestep without scanning the whole file
+INDEX_STATEMENTS = [
+    'CREATE INDEX IF NOT EXISTS text_key_value_index ON text_key_values(key, value, id)',
+    'CREATE INDEX IF NOT EXISTS text_id_key_index ON text_key_values(id, key, value)',
+    'CREATE INDEX IF NOT EXISTS number_key_value_index ON number_key_values(key, value, id)',
+    'CREATE INDEX IF NOT EXISTS number_id_key_index ON number_key_values(id, key, value)',
+]
+
+# Tables of an ASE database that get rows for every frame, in the order of get_frame_rows
+FRAME_TABLES = ('systems', 'species', 'text_key_values', 'number_key_values', 'keys')
+
+def is_sqlite_file(filename):
+    """Check if the file is an SQLite database."""
+    try:
+        with open(filename, 'rb') as handle:
+            return handle.read(16) == b'SQLite format 3\x00'
+    except OSError:
+        return False
+
+def create_indices(dbname):
+    """Create the indices used to select rows of an ASE database by state, run_number and timestep."""
+    if not is_sqlite_file(dbname):
+        return
+    connection = sqlite3.connect(dbname, timeout=20)
+    try:
+        for statement in INDEX_STATEMENTS:
+            connection.execute(statement)
+        connection.commit()
+    finally:
+        connection.close()
+
+def add_range(conditions, args, column, bounds):
+    """Add the condition that column lies in the inclusive bounds (min, max); None is unbounded."""
+    if bounds is None:
+        return
+    lower, upper = bounds
+    if lower is not None:
+        conditions.append(f'{column} >= ?')
+        args.append(lower)
+    if upper is not None:
+        conditions.append(f'{column} <= ?')
+        args.append(upper)
+
+def get_conditions(state_column, run_column, timestep_column, state, run_numbers, timesteps):
+    """Get the SQL conditions and their arguments for the selection of rows."""
+    conditions = []
+    args = []
+    if state is not None:
+        conditions.append(f'{state_column} = ?')
+        args.append(state)
+    add_range(conditions, args, run_column, run_numbers)
+    add_range(conditions, args, timestep_column, timesteps)
+    return conditions, args
+
+def insert_in_batches(connection, sql, rows, batch_size):
+    """Insert the rows with executemany in transactions of batch_size rows; return the number of rows."""
+    nrows = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            connection.executemany(sql, batch)
+            connection.commit()
+            nrows += len(batch)
+            batch = []
+    connection.executemany(sql, batch)
+    connection.commit()
+    return nrows + len(batch)
+
+def float_if_not_none(value):
+    """Convert a number to float, as ase.db does, unless it is None."""
+    return None if value is None else float(value)
+
+def atoms_to_row(atoms):
+    """Return the AtomsRow that ase.db writes for a frame read from a trajectory.
+
+    The same as ase.db.row.atoms2dict, but the results are taken from the
+    calculator as they are, without checking that the atoms have not changed
+    since they were computed, which is most of the time of a write.
+    """
+    dct = {'numbers': atoms.numbers, 'positions': atoms.positions, 'unique_id': uuid.uuid4().hex}
+    if atoms.pbc.any():
+        dct['pbc'] = atoms.pbc
+    if atoms.cell.any():
+        dct['cell'] = atoms.cell
+    if atoms.has('initial_magmoms'):
+        dct['initial_magmoms'] = atoms.get_initial_magnetic_moments()
+    if atoms.has('initial_charges'):
+        dct['initial_charges'] = atoms.get_initial_charges()
+    if atoms.has('masses'):
+        dct['masses'] = atoms.get_masses()
+    if atoms.has('tags'):
+        dct['tags'] = atoms.get_tags()
+    if atoms.has('momenta'):
+        dct['momenta'] = atoms.get_momenta()
+    if atoms.constraints:
+        dct['constraints'] = [constraint.todict() for constraint in atoms.constraints]
+    if atoms.calc is not None:
+        dct['calculator'] = atoms.calc.name.lower()
+        dct['calculator_parameters'] = atoms.calc.todict()
+        dct.update((name, value) for name, value in atoms.calc.results.items()
+                   if name in all_properties and value is not None)
+    return AtomsRow(dct)
+
+def get_frame_rows(database, atoms, key_value_pairs, id, user):
+    """Return the rows of every table in FRAME_TABLES for a frame, as ase.db writes them."""
+    row = atoms_to_row(atoms)
+    blob = database.blob
+    encode = database.encode
+    mtime = now()
+    constraints = encode(row._constraints) if row._constraints else None
+    calculator = (row.calculator, encode(row.calculator_parameters)) if 'calculator' in row else (None, None)
+    systems = ((id, row.unique_id, mtime, mtime, user, blob(row.numbers), blob(row.positions), blob(row.cell),
+                int(np.dot(row.pbc, [1, 2, 4])), blob(row.get('initial_magmoms')),
+                blob(row.get('initial_charges')), blob(row.get('masses')), blob(row.get('tags')),
+                blob(row.get('momenta')), constraints) + calculator +
+               (float_if_not_none(row.get('energy')), float_if_not_none(row.get('free_energy')),
+                blob(row.get('forces')), blob(row.get('stress')), blob(row.get('dipole')),
+                blob(row.get('magmoms')), row.get('magmom'), blob(row.get('charges')),
+                encode(key_value_pairs), encode(row._data, binary=True), len(row.numbers),
+                float_if_not_none(row.get('fmax')), float_if_not_none(row.get('smax')),
+                float_if_not_none(row.get('volume')), float(row.mass), float(row.charge)))
+    species = [(atomic_numbers[symbol], count, id) for symbol, count in row.count_atoms().items()]
+    text_key_values = []
+    number_key_values = []
+    for key, value in key_value_pairs.items():
+        if isinstance(value, (numbers.Real, np.bool_)):
+            number_key_values.append((key, float(value), id))
+        else:
+            text_key_values.append((key, value, id))
+    keys = [(key, id) for key in key_value_pairs]
+    return [systems], species, text_key_values, number_key_values, keys
+
+def can_insert_rows(database):
+    """Check if the rows of frames can be inserted directly, into an SQLite file with the current ase.db schema."""
+    if type(database) is not SQLite3Database:
+        return False
+    with database.managed_connection():
+        pass
+    return database.version == VERSION
+
+def insert_frame_rows(connection, tables):
+    """Insert the rows collected for every table and commit them."""
+    for table, rows in tables.items():
+        if rows:
+            connection.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(rows[0]))})", rows)
+            rows.clear()
+    connection.commit()
 
 @dataclass
 class StoreAtomsinASEdb:
     dbname: str
     foldername: str
+    batch_size: int = 1000
+    stream: bool = False
+    array_store: str = None
 
     def __post_init__(self):
         pass
@@ -22,26 +189,110 @@ class StoreAtomsinASEdb:
         """Validate that some specific optiosn exit."""
         assert op.exists(self.foldername), f"{self.foldername} does not exist"
         assert op.exists(op.join(self.foldername, 'details.yaml')), f"{op.join(self.foldername, 'details.yaml')} does not exist"
-        assert op.exists(op.join(self.foldername, 'vasprun.xml')), f"{op.join(self.foldername, 'vasprun.xml')} does not exist" 
+        assert op.exists(self.get_trajectory_filename()), f"{op.join(self.foldername, 'vasprun.xml')} does not exist"
         assert 'run_number' in self.specifics
         assert 'state' in self.specifics
         self.state = self.specifics.pop('state')
         self.run_number = self.specifics.pop('run_number')
         assert not self.specifics, f"{self.specifics} is not empty"
 
-    def store_attributes(self, vaspout='vasprun.xml'): 
-        """Store entry into ASE database based on the specics of the yaml file."""
-        print(f"Storing {self.foldername}")
+    def get_trajectory_filename(self, vaspout='vasprun.xml'):
+        """Get the path to the vasprun.xml or OUTCAR file of the trajectory.
+
+        If there is no vasprun.xml file in the folder, a compressed one is used.
+        """
         if vaspout:
-            atoms_traj = read(op.join(self.foldername, vaspout), ':')
+            filename = op.join(self.foldername, vaspout)
+            if not op.exists(filename):
+                for extension in COMPRESSIONS:
+                    if op.exists(filename + extension):
+                        return filename + extension
+            return filename
         else:
-            atoms_traj = read(op.join(self.foldername), ':')
+            return op.join(self.foldername)
+
+    def read_trajectory(self, vaspout='vasprun.xml', start=0):
+        """Read the frames of the trajectory, skipping the first start frames.
+
+        If stream is set, the frames are yielded one at a time as they are parsed
+        instead of reading the whole trajectory into a list of atoms objects.
+        """
+        filename = self.get_trajectory_filename(vaspout)
+        if self.stream:
+            return iread_trajectory(filename, start)
+        if get_compression(filename):
+            # ASE does not read compressed VASP outputs
+            return list(iread_trajectory(filename, start))
+        return read(filename, slice(start, None))
+
+    def open_array_store(self, start=0):
+        """Open the writer of the columnar array store, if one is used."""
+        if self.array_store is None:
+            return nullcontext()
+        return ArrayStore(self.array_store).open_run(self.state, self.run_number, start)
+
+    def write_trajectory(self, atoms_traj, start=0):
+        """Write the frames of a trajectory and print the rate at which they were written.
+
+        The timesteps are counted from start and the ids of the rows are returned.
+        """
+        start_time = time.perf_counter()
+        ids = self.write_frames(atoms_traj, start)
+        elapsed = time.perf_counter() - start_time
+        rate = len(ids) / elapsed if elapsed > 0 else float('inf')
+        print(f"Wrote {len(ids)} frames in {elapsed:.2f} s ({rate:.1f} frames/s)")
+        return ids
+
+    def iter_frames(self, atoms_traj, start, arrays):
+        """Yield the timestep and atoms of every frame, writing them to the array store if one is used."""
+        for index, atoms in enumerate(atoms_traj, start):
+            if arrays is not None:
+                arrays.write(atoms, index)
+            yield index, atoms
+
+    def write_frames(self, atoms_traj, start=0):
+        """Write the frames into the ASE database and return the ids of the rows.
+
+        The rows of an SQLite database are built from the results of the frames
+        and inserted with executemany, in transactions of batch_size frames; other
+        databases are written one row at a time through ase.db.
+        """
+        key_value_pairs = {'state':self.state, 'run_number':self.run_number, 'timestep':start}
+        check(key_value_pairs)
+        ids = []
+        with db.connect(self.dbname) as database, self.open_array_store(start) as arrays:
+            frames = self.iter_frames(atoms_traj, start, arrays)
+            if not can_insert_rows(database):
+                for index, atoms in frames:
+                    key_value_pairs['timestep'] = index
+                    ids.append(database.write(atoms, key_value_pairs))
+                return ids
+            connection = database.connection
+            user = os.getenv('USER')
+            # ase.db never reuses the ids of deleted rows
+            next_id = database.get_last_id(connection.cursor()) + 1
+            tables = {table: [] for table in FRAME_TABLES}
+            for index, atoms in frames:
+                key_value_pairs['timestep'] = index
+                for table, rows in zip(FRAME_TABLES, get_frame_rows(database, atoms, key_value_pairs, next_id, user)):
+                    tables[table].extend(rows)
+                ids.append(next_id)
+                next_id += 1
+                if len(ids) % self.batch_size == 0:
+                    insert_frame_rows(connection, tables)
+            insert_frame_rows(connection, tables)
+        return ids
+
+    def delete_rows(self, ids):
+        """Remove rows that were previously stored from the database."""
         with db.connect(self.dbname) as database:
-            for index, atoms in enumerate(atoms_traj):
-                specifics = {'state':self.state, 'run_number':self.run_number,} 
-                specifics['timestep'] = index
-                specifics['atoms'] = atoms
-                database.write(**specifics) 
+            database.delete(ids)
+
+    def store_attributes(self, vaspout='vasprun.xml', start=0): 
+        """Store entry into ASE database based on the specics of the yaml file."""
+        print(f"Storing {self.foldername}")
+        atoms_traj = self.read_trajectory(vaspout, start)
+        return self.write_trajectory(atoms_traj, start)
     
     def get_specifics_for_recursive(self):
         """Get the specifics for the folder if the default is recursive."""
@@ -62,7 +313,7 @@ class StoreAtomsinASEdb:
         # OUTCAR_1 is in the folder, then the run number is 1. If no number is found, then
         # the run number is 0.
         try:
-            self.run_number = int(self.foldername.split('/')[-1].split('_')[-1])
+            self.run_number = int(strip_compression(self.foldername.split('/')[-1]).split('_')[-1])
         except ValueError:
             self.run_number = 0
         self.specifics = {'state':self.state, 'run_number':self.run_number,}
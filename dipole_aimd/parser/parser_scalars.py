@@ -0,0 +1,88 @@
+"""Class to store only the energy and dipole moment of every frame into an SQLite database."""
+from dataclasses import dataclass
+import os.path as op
+import sqlite3
+from dipole_aimd.parser.parser_dipole import StoreAtomsinASEdb, insert_in_batches
+from dipole_aimd.parser.readers import iscan_trajectory
+
+SCALARS_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS scalars (
+    id INTEGER PRIMARY KEY,
+    state TEXT,
+    run_number INTEGER,
+    timestep INTEGER,
+    energy REAL,
+    free_energy REAL,
+    dipole_x REAL,
+    dipole_y REAL,
+    dipole_z REAL)""",
+    'CREATE INDEX IF NOT EXISTS scalars_index ON scalars(state, run_number, timestep)',
+]
+
+INSERT_SCALARS = 'INSERT INTO scalars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+def is_scalars_database(filename):
+    """Check if the file is a database written with --scalars-only."""
+    if not op.isfile(filename):
+        return False
+    connection = sqlite3.connect(filename)
+    try:
+        cursor = connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='scalars'")
+        return cursor.fetchone()[0] == 1
+    except sqlite3.DatabaseError:
+        # For example an ASE database stored as json
+        return False
+    finally:
+        connection.close()
+
+@dataclass
+class StoreScalarsinSQLite(StoreAtomsinASEdb):
+    """Store the energy and the dipole moment of every frame without the atoms objects.
+
+    The frames are scanned for the energies and the dipole only, and stored as a
+    single row of numbers in the scalars table, which is all the analysis of the
+    dipole moment and the energy needs.
+    """
+
+    def read_trajectory(self, vaspout='vasprun.xml', start=0):
+        """Yield the energy, free energy and dipole of the frames, skipping the first start frames."""
+        return iscan_trajectory(self.get_trajectory_filename(vaspout), start)
+
+    def connect(self):
+        """Connect to the database and create the table of scalars if needed."""
+        connection = sqlite3.connect(self.dbname, timeout=20)
+        cursor = connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ('systems', 'frames')")
+        if cursor.fetchone()[0]:
+            connection.close()
+            raise ValueError(f'{self.dbname} is an ASE or a compact database, use a different dbname for --scalars-only.')
+        for statement in SCALARS_SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    def get_rows(self, scalars_traj, start, first_id):
+        """Yield the rows of the scalars table for the frames, with ids counted from first_id."""
+        for row_id, (index, (energy, free_energy, dipole)) in enumerate(enumerate(scalars_traj, start), first_id):
+            dipole = dipole if dipole is not None else (None, None, None)
+            yield (row_id, self.state, self.run_number, index, energy, free_energy, *dipole)
+
+    def write_frames(self, scalars_traj, start=0):
+        """Write the energies and dipoles of a trajectory, batch_size rows per transaction."""
+        connection = self.connect()
+        try:
+            first_id = connection.execute('SELECT COALESCE(MAX(id), 0) FROM scalars').fetchone()[0] + 1
+            nrows = insert_in_batches(connection, INSERT_SCALARS, self.get_rows(scalars_traj, start, first_id),
+                                      self.batch_size)
+        finally:
+            connection.close()
+        return list(range(first_id, first_id + nrows))
+
+    def delete_rows(self, ids):
+        """Remove rows that were previously stored from the database."""
+        connection = self.connect()
+        try:
+            connection.executemany('DELETE FROM scalars WHERE id=?', [(row_id,) for row_id in ids])
+            connection.commit()
+        finally:
+            connection.close()
@@ -0,0 +1,368 @@
+"""Read the frames of VASP trajectories one at a time."""
+import bz2
+import gzip
+import io
+import lzma
+import os.path as op
+import re
+import shutil
+import subprocess
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+import numpy as np
+from ase import Atoms
+from ase.constraints import FixAtoms, FixScaled
+from ase.io import iread
+
+# Joules per eV, the value used by ase.io.vasp to convert the PSTRESS from kbar
+EVTOJ = 1.60217733E-19
+
+# Line after which the energies of an ionic step are written in the OUTCAR
+_OUTCAR_SCF_DELIM = b'FREE ENERGIE OF THE ION-ELECTRON SYSTEM'
+
+# Modules decompressing trajectories incrementally, by file extension
+COMPRESSIONS = {'.gz': gzip, '.bz2': bz2, '.xz': lzma, '.lzma': lzma}
+
+# Multithreaded decompressors run in a separate process, so that decompressing
+# overlaps with parsing; the first one installed is used, the module above
+# otherwise. gzip and bzip2 themselves are not faster through a pipe than zlib
+# and libbz2 in this process.
+DECOMPRESSORS = {
+    '.gz': [['pigz', '-dc']],
+    '.bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc']],
+    '.xz': [['xz', '-dc', '-T0']],
+    '.lzma': [['xz', '-dc', '--format=lzma']],
+}
+
+def get_compression(filename):
+    """Extension of a compressed file, None if the file is not compressed."""
+    extension = op.splitext(filename)[1]
+    return extension if extension in COMPRESSIONS else None
+
+def strip_compression(filename):
+    """The filename without the extension of the compression."""
+    return op.splitext(filename)[0] if get_compression(filename) else filename
+
+def get_decompressor(extension):
+    """Command of the first installed decompressor for the extension, None if there is none."""
+    for command in DECOMPRESSORS.get(extension, []):
+        if shutil.which(command[0]) is not None:
+            return command
+    return None
+
+class NamedTextIOWrapper(io.TextIOWrapper):
+    """Text stream of a decompressed file, with the name of the file.
+
+    The OUTCAR reader of ASE looks for the constraints in the folder of fd.name,
+    which a pipe or a compressed file object does not have.
+    """
+
+    def __init__(self, buffer, name):
+        super().__init__(buffer)
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+@contextmanager
+def open_trajectory(filename, external=True):
+    """Open a trajectory for reading in binary mode, decompressing it while it is read.
+
+    Compressed files are never decompressed to disk or into memory as a whole.
+    With external, an installed decompressor runs in a separate process and its
+    output is read from a pipe; the file object can then not seek.
+    """
+    extension = get_compression(filename)
+    if extension is None:
+        with open(filename, 'rb') as fd:
+            yield fd
+        return
+    command = get_decompressor(extension) if external else None
+    if command is None:
+        with COMPRESSIONS[extension].open(filename, 'rb') as fd:
+            yield fd
+        return
+    process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        yield process.stdout
+        # A truncated or corrupt file is only noticed from the exit code, which
+        # is checked if all the output was read
+        if not process.stdout.read(1) and process.wait() != 0:
+            raise OSError(f'{command[0]} could not decompress {filename}: '
+                          f'{process.stderr.read().decode(errors="replace").strip()}')
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.stderr.close()
+        process.wait()
+
+def get_xml_parameter(par):
+    """Convert a parameter of the vasprun.xml file to its python type."""
+    to_type = {'int': int, 'logical': lambda b: b == 'T', 'string': str, 'float': float}
+    text = par.text
+    if text is None:
+        text = ''
+    # Float parameters do not have a 'type' attrib
+    var_type = to_type[par.attrib.get('type', 'float')]
+    try:
+        if par.tag == 'v':
+            return list(map(var_type, text.split()))
+        else:
+            return var_type(text.strip())
+    except ValueError:
+        # Vasp can sometimes write "*****" due to overflow
+        return None
+
+def iread_vasprun(fd, start=0):
+    """Yield an atoms object for every <calculation> block of a vasprun.xml file.
+
+    The header is parsed in the same way as ase.io.read, but every calculation
+    block is removed from the tree once it has been converted, so that the memory
+    used does not grow with the length of the trajectory. The first start blocks
+    are skipped without building atoms objects.
+
+    Versions of ASE without ase.io.vasp.atoms_from_step read the file with
+    ase.io.iread instead, which keeps the calculation blocks in memory.
+    """
+    try:
+        from ase.io.vasp import atoms_from_step
+    except ImportError:
+        yield from iread(fd, slice(start, None), format='vasp-xml')
+        return
+    context = ET.iterparse(fd, events=('start', 'end'))
+    atoms_init = None
+    ibz_kpts = None
+    kpt_weights = None
+    parameters = OrderedDict()
+    ncalculations = 0
+    try:
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end':
+                continue
+            if elem.tag == 'kpoints':
+                kpts = elem.findall("varray[@name='kpointlist']/v")
+                ibz_kpts = np.zeros((len(kpts), 3))
+                for i, kpt in enumerate(kpts):
+                    ibz_kpts[i] = [float(val) for val in kpt.text.split()]
+                kpt_weights = elem.findall('varray[@name="weights"]/v')
+                kpt_weights = [float(val.text) for val in kpt_weights]
+            elif elem.tag == 'parameters':
+                for par in elem.iter():
+                    if par.tag in ['v', 'i']:
+                        parameters[par.attrib['name'].lower()] = get_xml_parameter(par)
+            elif elem.tag == 'atominfo':
+                species = [entry[0].text.strip() for entry in elem.find("array[@name='atoms']/set")]
+                natoms = len(species)
+            elif elem.tag == 'structure' and elem.attrib.get('name') == 'initialpos':
+                cell_init = np.array([[float(val) for val in v.text.split()]
+                                      for v in elem.find("crystal/varray[@name='basis']")])
+                scpos_init = np.array([[float(val) for val in v.text.split()]
+                                       for v in elem.find("varray[@name='positions']")])
+                constraints = []
+                fixed_indices = []
+                for i, entry in enumerate(elem.findall("varray[@name='selective']/v")):
+                    flags = np.array(entry.text.split() == np.array(['F', 'F', 'F']))
+                    if flags.all():
+                        fixed_indices.append(i)
+                    elif flags.any():
+                        constraints.append(FixScaled(i, flags, cell_init))
+                if fixed_indices:
+                    constraints.append(FixAtoms(fixed_indices))
+                atoms_init = Atoms(species, cell=cell_init, scaled_positions=scpos_init,
+                                   constraint=constraints, pbc=True)
+            elif elem.tag == 'calculation':
+                ncalculations += 1
+                if ncalculations <= start:
+                    root.clear()
+                    continue
+                atoms = atoms_from_step(elem, ibz_kpts=ibz_kpts, kpt_weights=kpt_weights,
+                                        parameters=parameters, atoms=atoms_init.copy(),
+                                        natoms=natoms)
+                # Drop the parsed calculation block before moving on
+                root.clear()
+                yield atoms
+    except ET.ParseError:
+        # A running job has an incomplete last calculation block
+        if atoms_init is None:
+            raise
+        if not ncalculations and not start:
+            yield atoms_init
+
+def iread_trajectory(filename, start=0):
+    """Yield the frames of a vasprun.xml or an OUTCAR file one at a time, from start; either can be compressed."""
+    if '.xml' in op.basename(filename):
+        with open_trajectory(filename) as fd:
+            yield from iread_vasprun(fd, start)
+    elif get_compression(filename):
+        with open_trajectory(filename) as fd:
+            text = NamedTextIOWrapper(fd, filename)
+            try:
+                yield from iread(text, slice(start, None), format='vasp-out')
+            finally:
+                # Leave closing the binary stream to open_trajectory
+                text.detach()
+    else:
+        # The OUTCAR reader of ASE already builds one ionic step at a time
+        yield from iread(filename, slice(start, None), format='vasp-out')
+
+# Dipole and energies of an ionic step in an OUTCAR file
+_OUTCAR_SCALARS = re.compile(
+    rb'dipolmoment +(\S+) +(\S+) +(\S+)'
+    rb'|' + _OUTCAR_SCF_DELIM + rb'.*\n.*\n *free  energy +TOTEN += *(\S+).*\n.*\n'
+    rb' *energy  without entropy= *\S+ +energy\(sigma->0\) += *(\S+)'
+)
+
+def iter_blocks(fd, find_end, block_size=1 << 23):
+    """Read a binary file in blocks that end where find_end says the text is complete.
+
+    find_end returns the index up to which a buffer can be processed; the rest is
+    carried over to the next block. At the end of the file the remainder is returned.
+    """
+    remainder = b''
+    while True:
+        data = fd.read(block_size)
+        if not data:
+            if remainder:
+                yield remainder
+            return
+        buffer = remainder + data
+        end = find_end(buffer)
+        remainder = buffer[end:]
+        if end:
+            yield buffer[:end]
+
+def _end_of_calculation(buffer):
+    """Index after the last complete <calculation> block."""
+    index = buffer.rfind(b'</calculation>')
+    return 0 if index == -1 else index + len(b'</calculation>')
+
+def _end_of_ionic_step(buffer):
+    """Index of the last line that does not split the energies of an ionic step."""
+    index = buffer.rfind(_OUTCAR_SCF_DELIM)
+    if index != -1 and buffer.count(b'\n', index) < 5:
+        return index
+    return buffer.rfind(b'\n') + 1
+
+def _get_text(buffer, key, start, end):
+    """Text of the first element with key between start and end of the buffer."""
+    index = buffer.index(key, start, end)
+    index = buffer.index(b'>', index) + 1
+    return buffer[index:buffer.index(b'<', index)]
+
+def read_vasprun_pstress(fd):
+    """Return the PSTRESS parameter of a vasprun.xml file, read from the header before the first calculation."""
+    header = b''
+    while b'<calculation>' not in header:
+        data = fd.read(1 << 20)
+        if not data:
+            break
+        header += data
+    end = header.find(b'<calculation>')
+    end = len(header) if end == -1 else end
+    index = header.find(b'name="PSTRESS"', 0, end)
+    return float(_get_text(header, b'name="PSTRESS"', index, end)) if index != -1 else 0.0
+
+def iscan_vasprun(fd, pstress=None, with_offsets=False):
+    """Yield the energy, free energy and dipole of every <calculation> block.
+
+    The vasprun.xml file is searched for the energy and dipole elements only,
+    without building the xml tree. The energies are corrected in the same way as
+    in ase.io.read, so that the values are the same as those of the atoms objects.
+    If the file is not read from its start, pstress has to be given. With
+    with_offsets, the number of bytes read up to the end of the block is also yielded.
+    """
+    consumed = 0
+    for block in iter_blocks(fd, _end_of_calculation):
+        start = block.find(b'<calculation>')
+        if pstress is None:
+            # The parameters are written before the first calculation
+            index = block.find(b'name="PSTRESS"', 0, start)
+            pstress = float(_get_text(block, b'name="PSTRESS"', index, start)) if index != -1 else 0.0
+        while start != -1:
+            end = block.find(b'</calculation>', start)
+            if end == -1:
+                # Incomplete calculation at the end of the file of a running job
+                break
+            # The last energy block is that of the calculation, the one before
+            # belongs to the last electronic step
+            final = block.rfind(b'<energy>', start, end)
+            lastscf = block.rfind(b'<energy>', start, final)
+            free_energy = float(_get_text(block, b'name="e_fr_energy"', final, end))
+            if pstress:
+                # e_fr_energy of the calculation includes the PV term
+                index = block.index(b'name="basis"', start, end)
+                cell = [[float(val) for val in _get_text(block, b'<v>', index, end).split()]]
+                for _ in range(2):
+                    index = block.index(b'</v>', index, end) + 1
+                    cell.append([float(val) for val in _get_text(block, b'<v>', index, end).split()])
+                free_energy -= pstress * 1e-22 / EVTOJ * np.linalg.det(cell)
+            energy = free_energy + float(_get_text(block, b'name="e_0_energy"', lastscf, final)) \
+                - float(_get_text(block, b'name="e_fr_energy"', lastscf, final))
+            # A dipole of the whole calculation comes after the last scstep
+            index = block.rfind(b'name="dipole"', start, end)
+            dipole = None
+            if index != -1:
+                dipole = [float(val) for val in _get_text(block, b'name="dipole"', index, end).split()]
+            if with_offsets:
+                yield energy, free_energy, dipole, consumed + end + len(b'</calculation>')
+            else:
+                yield energy, free_energy, dipole
+            start = block.find(b'<calculation>', end)
+        consumed += len(block)
+
+def iscan_outcar(fd, with_offsets=False):
+    """Yield the energy, free energy and dipole of every ionic step of an OUTCAR file.
+
+    The dipole is the last one written before the energies of the ionic step,
+    and is None if the dipole correction is not used. With with_offsets, the
+    number of bytes read up to the end of the ionic step is also yielded.
+    """
+    dipole = None
+    consumed = 0
+    for block in iter_blocks(fd, _end_of_ionic_step):
+        for match in _OUTCAR_SCALARS.finditer(block):
+            dipole_x, dipole_y, dipole_z, free_energy, energy = match.groups()
+            if dipole_x is not None:
+                dipole = [float(dipole_x), float(dipole_y), float(dipole_z)]
+                continue
+            end = block.find(b'\n', match.end())
+            if end == -1:
+                # The last line of a running job can be incomplete
+                return
+            if with_offsets:
+                yield float(energy), float(free_energy), dipole, consumed + end + 1
+            else:
+                yield float(energy), float(free_energy), dipole
+            dipole = None
+        consumed += len(block)
+
+def iscan_trajectory(filename, start=0):
+    """Yield the energy, free energy and dipole of the frames of a file, from start; it can be compressed."""
+    with open_trajectory(filename) as fd:
+        if '.xml' in op.basename(filename):
+            yield from islice(iscan_vasprun(fd), start, None)
+        else:
+            yield from islice(iscan_outcar(fd), start, None)
+
+def tail_trajectory(filename, offset=0):
+    """Yield the energy, free energy, dipole and end offset of the complete frames written after offset.
+
+    The end offset of the last frame is where the next call continues, so that a
+    file that is still being written is read only once. The offsets of a
+    compressed file are those of the decompressed text.
+    """
+    with open_trajectory(filename, external=False) as fd:
+        if '.xml' in op.basename(filename):
+            pstress = read_vasprun_pstress(fd)
+            fd.seek(offset)
+            frames = iscan_vasprun(fd, pstress=pstress, with_offsets=True)
+        else:
+            fd.seek(offset)
+            frames = iscan_outcar(fd, with_offsets=True)
+        for energy, free_energy, dipole, end in frames:
+            yield energy, free_energy, dipole, offset + end
@@ -0,0 +1,137 @@
+"""Json-lines report of an ingest with the time spent in every stage of every trajectory."""
+import json
+import os.path as op
+import time
+import traceback
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+# Stages of storing a trajectory: reading the details and the manifest, parsing
+# the frames and writing them to the database
+STAGES = ('prepare', 'parse', 'write')
+
+def get_trajectory_size(method, vaspout):
+    """Size in bytes of the file the frames of a trajectory are read from, None if it cannot be found.
+
+    With --incremental, the whole file is still parsed to reach the new frames of
+    a grown file, so this is the size of the file rather than of the new frames.
+    """
+    try:
+        return op.getsize(method.get_trajectory_filename(vaspout))
+    except (OSError, AttributeError):
+        return None
+
+@dataclass
+class StageTimer:
+    """Wall time spent in each stage of storing a trajectory.
+
+    A stage entered within another one pauses it, so that when the frames are
+    parsed while they are written (--stream), the time of parsing is not also
+    counted as time of writing.
+    """
+    times: dict = field(default_factory=lambda: dict.fromkeys(STAGES, 0.0))
+    active: list = field(default_factory=list)
+    last: float = field(default_factory=time.perf_counter)
+
+    def charge(self):
+        """Add the time since the last change of stage to the current stage."""
+        now = time.perf_counter()
+        if self.active:
+            self.times[self.active[-1]] += now - self.last
+        self.last = now
+
+    @contextmanager
+    def stage(self, name):
+        """Count the time spent in the block as time of the stage."""
+        self.charge()
+        self.active.append(name)
+        try:
+            yield
+        finally:
+            self.charge()
+            self.active.pop()
+
+    def iterate(self, frames, name='parse'):
+        """Yield the frames, counting the time spent producing each of them as time of the stage."""
+        with self.stage(name):
+            iterator = iter(frames)
+        while True:
+            with self.stage(name):
+                try:
+                    frame = next(iterator)
+                except StopIteration:
+                    return
+            yield frame
+
+@dataclass
+class IngestReport:
+    """Report of an ingest, with one json line per event.
+
+    A start line records the options of the ingest, a discover line the time spent
+    finding the trajectories, a file line for every trajectory its status (stored,
+    skipped or failed), the number of frames, the size of the file (file_bytes), the
+    time of every stage and, for failures, the exception with its traceback, and a summary line
+    the totals of the run. Lines are appended, so that a report can collect
+    several runs.
+    Inputs
+    ------
+    filename: str
+        The path to the json-lines report, nothing is written if None.
+    """
+    filename: str = None
+
+    def __post_init__(self):
+        self.start_time = time.perf_counter()
+        self.counts = {'stored': 0, 'skipped': 0, 'failed': 0}
+        self.frames = 0
+        self.file_bytes = 0
+        self.times = dict.fromkeys(('discover',) + STAGES, 0.0)
+
+    def log(self, event, **record):
+        """Append a line to the report."""
+        if self.filename is None:
+            return
+        record = {'event': event, 'date': datetime.now(timezone.utc).isoformat(), **record}
+        with open(self.filename, 'a') as handle:
+            handle.write(json.dumps(record) + '\n')
+
+    def start(self, **options):
+        """Record the options of the ingest."""
+        self.log('start', **options)
+
+    def discovered(self, foldernames, elapsed):
+        """Record the trajectories that were found and the time it took."""
+        self.times['discover'] += elapsed
+        self.log('discover', trajectories=len(foldernames), time=elapsed)
+
+    def trajectory(self, foldername, status, timer, frames=0, size=None, error=None):
+        """Record a trajectory that was stored, skipped or failed."""
+        self.counts[status] += 1
+        self.frames += frames
+        self.file_bytes += size or 0
+        for stage, elapsed in timer.times.items():
+            self.times[stage] += elapsed
+        total = sum(timer.times.values())
+        record = {'path': foldername, 'status': status, 'frames': frames, 'file_bytes': size,
+                  'time': dict(timer.times, total=total),
+                  'frames_per_second': frames / total if total > 0 else None}
+        if error is not None:
+            record['error'] = {'type': type(error).__name__, 'message': str(error),
+                               'traceback': ''.join(traceback.format_exception(type(error), error,
+                                                                               error.__traceback__))}
+        self.log('file', **record)
+
+    def summary(self, **extra):
+        """Record and print the totals of the run.
+
+        With several workers the times of parsing are summed over the workers, so
+        that they can be larger than the wall time.
+        """
+        wall_time = time.perf_counter() - self.start_time
+        rate = self.frames / wall_time if wall_time > 0 else None
+        self.log('summary', **self.counts, frames=self.frames, file_bytes=self.file_bytes,
+                 time=dict(self.times, wall=wall_time), frames_per_second=rate, **extra)
+        stages = ', '.join(f'{stage} {elapsed:.2f} s' for stage, elapsed in self.times.items())
+        print(f"Stored {self.counts['stored']}, skipped {self.counts['skipped']} and failed "
+              f"{self.counts['failed']} trajectories: {self.frames} frames in {wall_time:.2f} s ({stages})")